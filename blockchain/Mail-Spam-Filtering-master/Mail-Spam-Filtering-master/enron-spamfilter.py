@@ -8,94 +8,128 @@ Created on Tue Jan 31 15:00:44 2017
 import os
 import numpy as np
 from collections import Counter
-from sklearn.model_selection import train_test_split
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix, save_npz, load_npz
+from sklearn.linear_model import SGDClassifier
 from sklearn.naive_bayes import MultinomialNB
 from sklearn.metrics import confusion_matrix
-from sklearn.svm import LinearSVC
 
 
-def make_Dictionary(root_dir):
+def list_emails(root_dir):
+    emails = []
     emails_dirs = [os.path.join(root_dir,f) for f in os.listdir(root_dir)]    
-    all_words = []       
     for emails_dir in emails_dirs:
         dirs = [os.path.join(emails_dir,f) for f in os.listdir(emails_dir)]
         for d in dirs:
-            emails = [os.path.join(d,f) for f in os.listdir(d)]
-            for mail in emails:
-                with open(mail) as m:
-                    for line in m:
-                        words = line.split()
-                        all_words += words
-    dictionary = Counter(all_words)
-    list_to_remove = dictionary.keys()
-    
-    for item in list_to_remove:
+            emails += [os.path.join(d,f) for f in os.listdir(d)]
+    return emails
+
+def count_words(emails):
+    # Count one shard line by line, the words of a whole corpus are never held in a list
+    counter = Counter()
+    for mail in emails:
+        with open(mail) as m:
+            for line in m:
+                counter.update(line.split())
+    for item in list(counter.keys()):
         if item.isalpha() == False: 
-            del dictionary[item]
+            del counter[item]
         elif len(item) == 1:
-            del dictionary[item]
-    dictionary = dictionary.most_common(3000)
+            del counter[item]
+    return counter
+
+def make_Dictionary(root_dir, processes=None, shard_size=1000):
+    emails = list_emails(root_dir)
+    shards = [emails[i:i + shard_size] for i in range(0, len(emails), shard_size)]
+    dictionary = Counter()
+    with Pool(processes) as pool:
+        for counter in pool.imap_unordered(count_words, shards):
+            dictionary.update(counter)
+    # Ties are broken by the word, so every run gives the same dictionary
+    dictionary = sorted(dictionary.items(), key=lambda d: (-d[1], d[0]))[:3000]
     
     np.save('dict_enron.npy',dictionary) 
     
     return dictionary
     
-def extract_features(root_dir): 
-    emails_dirs = [os.path.join(root_dir,f) for f in os.listdir(root_dir)]  
-    docID = 0
-    features_matrix = np.zeros((33716,3000))
-    train_labels = np.zeros(33716)
-    for emails_dir in emails_dirs:
-        dirs = [os.path.join(emails_dir,f) for f in os.listdir(emails_dir)]
-        for d in dirs:
-            emails = [os.path.join(d,f) for f in os.listdir(d)]
-            for mail in emails:
-                with open(mail) as m:
-                    all_words = []
-                    for line in m:
-                        words = line.split()
-                        all_words += words
-                    for word in all_words:
-                      wordID = 0
-                      for i,d in enumerate(dictionary):
-                        if d[0] == word:
-                          wordID = i
-                          features_matrix[docID,wordID] = all_words.count(word)
-                train_labels[docID] = int(mail.split(".")[-2] == 'spam')
-                docID = docID + 1                
-    return features_matrix,train_labels
-    
-#Create a dictionary of words with its frequency
-
-root_dir = 'Enron-data-set'
-dictionary = make_Dictionary(root_dir)
-
-
-#Prepare feature vectors per training mail and its labels
-
-features_matrix,labels = extract_features(root_dir)
-np.save('enron_features_matrix.npy',features_matrix)
-np.save('enron_labels.npy',labels)
-
-
-#train_matrix = np.load('enron_features_matrix.npy');
-#labels = np.load('enron_labels.npy');
-print features_matrix.shape
-print labels.shape
-print sum(labels==0),sum(labels==1)
-X_train, X_test, y_train, y_test = train_test_split(features_matrix, labels, test_size=0.40)
-
-## Training models and its variants
-
-model1 = LinearSVC()
-model2 = MultinomialNB()
-
-model1.fit(X_train,y_train)
-model2.fit(X_train,y_train)
-
-result1 = model1.predict(X_test)
-result2 = model2.predict(X_test)
-
-print confusion_matrix(y_test, result1)
-print confusion_matrix(y_test, result2)
-
+def extract_features(root_dir, dictionary, out_dir='enron_features', shard_size=2000, seed=42):
+    # Sparse feature shards on disk instead of one dense 33716 x 3000 matrix:
+    # <out_dir>/shard_00000.npz (CSR counts) and shard_00000_labels.npy
+    vocabulary = dict((d[0], i) for i, d in enumerate(dictionary))
+    # list_emails groups the mails by enronN/ham and enronN/spam, shuffled every shard mixes both classes
+    emails = sorted(list_emails(root_dir))
+    np.random.RandomState(seed).shuffle(emails)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    shards = []
+    for start in range(0, len(emails), shard_size):
+        indptr = [0]
+        indices = []
+        data = []
+        labels = []
+        for mail in emails[start:start + shard_size]:
+            counts = Counter()
+            with open(mail) as m:
+                for line in m:
+                    counts.update(line.split())
+            for word, count in counts.items():
+                wordID = vocabulary.get(word)
+                if wordID is not None:
+                    indices.append(wordID)
+                    data.append(count)
+            indptr.append(len(indices))
+            labels.append(int(mail.split(".")[-2] == 'spam'))
+        features_matrix = csr_matrix((data, indices, indptr), shape=(len(labels), 3000), dtype=np.float64)
+        path = os.path.join(out_dir, 'shard_%05d' % (start // shard_size))
+        save_npz(path + '.npz', features_matrix)
+        np.save(path + '_labels.npy', np.array(labels, dtype=np.float64))
+        shards.append(path)
+    return shards
+
+def load_shards(shards, test_size=0.40, test=False, seed=42):
+    # Yield the train (or test) rows of every shard, the split is fixed per shard by the seed
+    # and the shard number, so it does not change when the shards are visited in another order
+    for path in shards:
+        features_matrix = load_npz(path + '.npz')
+        labels = np.load(path + '_labels.npy')
+        is_test = np.random.RandomState(seed + int(path[-5:])).rand(len(labels)) < test_size
+        rows = np.flatnonzero(is_test if test else ~is_test)
+        yield features_matrix[rows], labels[rows]
+
+# Spawned pool workers (Windows, macOS) import this script, only the parent may run it
+if __name__ == '__main__':
+    #Create a dictionary of words with its frequency
+
+    root_dir = 'Enron-data-set'
+    dictionary = make_Dictionary(root_dir)
+
+
+    #Prepare sparse feature shards per mail and its labels
+
+    shards = extract_features(root_dir, dictionary)
+
+
+    ## Training models and its variants, one shard in memory at a time
+    ## SGDClassifier with hinge loss is the linear SVM that can learn incrementally,
+    ## it needs several passes over the shards, in a new order every epoch
+
+    model1 = SGDClassifier(loss='hinge')
+    model2 = MultinomialNB()
+    epochs = 5
+
+    for epoch in range(epochs):
+        order = np.random.RandomState(epoch).permutation(len(shards))
+        for X_train, y_train in load_shards([shards[i] for i in order]):
+            model1.partial_fit(X_train, y_train, classes=[0, 1])
+            # Naive Bayes only counts, one pass is its whole training
+            if epoch == 0:
+                model2.partial_fit(X_train, y_train, classes=[0, 1])
+
+    result1 = np.zeros((2, 2), dtype=np.int64)
+    result2 = np.zeros((2, 2), dtype=np.int64)
+    for X_test, y_test in load_shards(shards, test=True):
+        result1 += confusion_matrix(y_test, model1.predict(X_test), labels=[0, 1])
+        result2 += confusion_matrix(y_test, model2.predict(X_test), labels=[0, 1])
+
+    print(result1)
+    print(result2)
@@ -0,0 +1,109 @@
+import contextlib
+import os
+from argparse import ArgumentParser
+from time import perf_counter, time
+from typing import Any, Dict, List
+
+from blockchain import Blockchain
+
+"""
+valid_chain benchmark on a synthetic chain
+
+    python bench_valid_chain.py -n 100000
+"""
+
+
+def fixed_point_proof() -> int:
+    """
+    Find a proof p with valid_proof(p, p), so a chain of any length can reuse it without mining
+    """
+
+    proof = 0
+    while not Blockchain.valid_proof(proof, proof):
+        proof += 1
+    return proof
+
+
+def synthetic_chain(length: int, transactions: int = 3) -> List[Dict[str, Any]]:
+    """
+    Build a valid chain of `length` blocks, each with a few transactions
+
+    :param length: Number of blocks
+    :param transactions: Transactions per block
+    """
+
+    proof = fixed_point_proof()
+    chain = []
+    previous_hash = '1'
+    for index in range(1, length + 1):
+        block = {
+            'index': index,
+            'timestamp': time(),
+            'transactions': [{'sender': f'{index}-{i}', 'recipient': 'node', 'amount': i}
+                             for i in range(transactions)],
+            'proof': proof,
+            'previous_hash': previous_hash,
+        }
+        chain.append(block)
+        previous_hash = Blockchain.hash(block)
+    return chain
+
+
+def legacy_valid_chain(chain: List[Dict[str, Any]]) -> bool:
+    """
+    valid_chain as it was, printing both blocks of every link
+    """
+
+    last_block = chain[0]
+    current_index = 1
+
+    while current_index < len(chain):
+        block = chain[current_index]
+        print(f'{last_block}')
+        print(f'{block}')
+        print("\n-----------\n")
+        # Check that the hash of the block is correct
+        if block['previous_hash'] != Blockchain.hash(last_block):
+            return False
+
+        # Check that the Proof of Work is correct
+        if Blockchain.valid_proof(last_block['proof'], block['proof']) is False:
+            return False
+
+        last_block = block
+        current_index += 1
+
+    return True
+
+
+def timed(name: str, function, *args, **kwargs) -> float:
+    start = perf_counter()
+    assert function(*args, **kwargs)
+    seconds = perf_counter() - start
+    print(f'{name:<24}: {seconds:8.3f} s')
+    return seconds
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--length', default=100000, type=int, help='blocks in the synthetic chain')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='proof checking processes, default all cores')
+    parser.add_argument('-s', '--suffix', default=1000, type=int, help='unknown blocks for the suffix run')
+    args = parser.parse_args()
+
+    chain = synthetic_chain(args.length)
+    blockchain = Blockchain()
+    workers = args.workers or os.cpu_count() or 1
+    print(f'{args.length} blocks, {workers} workers')
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = perf_counter()
+        assert legacy_valid_chain(chain)
+        legacy = perf_counter() - start
+    print(f'{"legacy (stdout to null)":<24}: {legacy:8.3f} s')
+
+    serial = timed('valid_chain, 1 worker', blockchain.valid_chain, chain, workers=1)
+    parallel = timed(f'valid_chain, {workers} workers', blockchain.valid_chain, chain, workers=workers)
+    suffix = timed(f'last {args.suffix} blocks only', blockchain.valid_chain, chain,
+                   known=args.length - args.suffix)
+    print(f'speedup: {legacy / serial:.1f}x serial, {legacy / parallel:.1f}x parallel, {legacy / suffix:.0f}x suffix')
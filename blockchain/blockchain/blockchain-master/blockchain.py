@@ -1,7 +1,13 @@
 import hashlib
 import json
-from time import time
-from typing import Any, Dict, List, Optional
+import multiprocessing
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 from uuid import uuid4
 
@@ -9,11 +15,217 @@ import requests
 from flask import Flask, jsonify, request
 
 
+# valid_proof's four leading hex zeroes are 16 leading zero bits
+DIFFICULTY_BITS = 16
+
+# (connect, read) timeouts in seconds for one peer request
+PEER_TIMEOUT = (3.05, 5)
+CHAIN_TIMEOUT = (3.05, 60)
+
+# Most headers / blocks a node hands out per request
+MAX_HEADERS = 2000
+MAX_BLOCKS = 500
+
+# Chains with more blocks than this are checked on a process pool
+PARALLEL_BLOCKS = 20000
+
+# json.dumps(sort_keys=True) without building a new encoder for every call
+_canonical_json = json.JSONEncoder(sort_keys=True)
+
+# Pools are started from request and mining threads once app.run holds the socket,
+# spawned workers do not inherit it and keep the port bound after the node exits
+_process_context = multiprocessing.get_context('spawn')
+
+# Set in every mining worker by the pool initializer
+_cancel_event = None
+
+
+def _init_miner_worker(cancel_event) -> None:
+    global _cancel_event
+    _cancel_event = cancel_event
+
+
+# Keys and types of the block headers and locator entries exchanged between nodes
+HEADER_TYPES = {'index': int, 'hash': str, 'previous_hash': str, 'proof': int}
+LOCATOR_TYPES = {'index': int, 'hash': str}
+
+
+def _has_types(value: Any, types: Dict[str, type]) -> bool:
+    """
+    Check the shape of json from another node before using it
+
+    :param value: Decoded json
+    :param types: Key --> exact type, so True is not taken for an int
+    :return: True if value is a dict holding every key with its type
+    """
+
+    return isinstance(value, dict) and all(type(value.get(key)) is kind for key, kind in types.items())
+
+
+def _target(difficulty_bits: int) -> bytes:
+    """
+    Digests below this value have at least `difficulty_bits` leading zero bits
+    """
+
+    return (1 << (256 - difficulty_bits)).to_bytes(32, 'big')
+
+
+def _search_nonces(last_proof: int, start: int, end: int, target: bytes) -> Tuple[Optional[int], int]:
+    """
+    Mining worker: look for the smallest proof in [start, end)
+
+    :param last_proof: Previous Proof
+    :param start: First proof to try
+    :param end: End of the nonce range (exclusive)
+    :param target: Raw digest bound from _target()
+    :return: (proof or None, number of hashes computed)
+    """
+
+    # Hash the last proof once, every attempt only adds its own digits
+    prefix = hashlib.sha256(str(last_proof).encode())
+    for proof in range(start, end):
+        guess = prefix.copy()
+        guess.update(str(proof).encode())
+        if guess.digest() < target:
+            return proof, proof - start + 1
+        if proof & 0xfff == 0 and _cancel_event is not None and _cancel_event.is_set():
+            return None, proof - start + 1
+
+    return None, end - start
+
+
+PROOF_TARGET = _target(DIFFICULTY_BITS)
+
+
+def _valid_proofs(pairs: List[Tuple[int, int]]) -> bool:
+    """
+    Check a run of (last_proof, proof) pairs, see Blockchain.valid_proof
+
+    :param pairs: (Previous Proof, Current Proof) of consecutive blocks
+    :return: True if every proof is correct
+    """
+
+    sha256 = hashlib.sha256
+    target = PROOF_TARGET
+    for last_proof, proof in pairs:
+        if sha256(f'{last_proof}{proof}'.encode()).digest() >= target:
+            return False
+    return True
+
+
+def _validate_range(blocks: List[Dict[str, Any]]) -> bool:
+    """
+    Check the hash links and Proofs of Work of consecutive blocks, the first one is trusted
+
+    :param blocks: A run of consecutive blocks
+    :return: True if valid, False if not
+    """
+
+    # Every block is serialized and hashed exactly once
+    hashes = [Blockchain.hash(block) for block in blocks]
+    for last_hash, block in zip(hashes, blocks[1:]):
+        if block['previous_hash'] != last_hash:
+            return False
+
+    return _valid_proofs([(last_block['proof'], block['proof']) for last_block, block in zip(blocks, blocks[1:])])
+
+
+class ProofOfWorkMiner:
+    """
+    Finds the same proof as Blockchain.proof_of_work, on every core
+
+    The nonce space is cut into chunks that are searched by a process pool.
+    Chunks are collected in order, so the first hit is the smallest proof.
+    """
+
+    def __init__(self, workers: Optional[int] = None, chunk_size: int = 16384,
+                 difficulty_bits: int = DIFFICULTY_BITS):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.target = _target(difficulty_bits)
+        self.cancel_event = _process_context.Event()
+        self.lock = threading.Lock()
+        self.pool = None
+        self.last_report: Dict[str, Any] = {}
+
+    def _start(self) -> None:
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_process_context,
+                                            initializer=_init_miner_worker, initargs=(self.cancel_event,))
+
+    def mine(self, last_proof: int) -> Optional[int]:
+        """
+        Search for the next proof
+
+        :param last_proof: Previous Proof
+        :return: The proof, or None if cancel() was called meanwhile
+        """
+
+        with self.lock:
+            self._start()
+            self.cancel_event.clear()
+            started = perf_counter()
+            hashes = 0
+            proof = None
+            next_start = 0
+            pending = []
+            try:
+                while proof is None and not self.cancel_event.is_set():
+                    # Keep every worker busy with a chunk queued behind it
+                    while len(pending) < self.workers * 2:
+                        pending.append(self.pool.submit(_search_nonces, last_proof, next_start,
+                                                        next_start + self.chunk_size, self.target))
+                        next_start += self.chunk_size
+                    proof, tried = pending.pop(0).result()
+                    hashes += tried
+            finally:
+                # Stop the chunks still running, a found proof or a cancel makes them useless
+                self.cancel_event.set()
+                for future in pending:
+                    if not future.cancel():
+                        hashes += future.result()[1]
+
+            seconds = perf_counter() - started
+            self.last_report = {
+                'proof': proof,
+                'hashes': hashes,
+                'seconds': seconds,
+                'hashes_per_s': hashes / seconds if seconds else 0.0,
+                'workers': self.workers,
+            }
+            return proof
+
+    def cancel(self) -> None:
+        """
+        Abandon the running search, e.g. because a peer block replaced our tip
+        """
+
+        self.cancel_event.set()
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.cancel()
+            self.pool.shutdown()
+            self.pool = None
+
+
 class Blockchain:
-    def __init__(self):
+    def __init__(self, miner: Optional[ProofOfWorkMiner] = None):
         self.current_transactions = []
         self.chain = []
+        # hash() of every block in chain, so a block is serialized once
+        self.hashes = []
         self.nodes = set()
+        self.miner = miner
+        # Guards chain and current_transactions against the background miner
+        self.lock = threading.RLock()
+
+        # Keep-alive connections to the peers, shared by the consensus threads
+        self.peer_workers = 16
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.peer_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
         # Create the genesis block
         self.new_block(previous_hash='1', proof=100)
@@ -28,34 +240,65 @@ class Blockchain:
         parsed_url = urlparse(address)
         self.nodes.add(parsed_url.netloc)
 
-    def valid_chain(self, chain: List[Dict[str, Any]]) -> bool:
+    def valid_chain(self, chain: List[Dict[str, Any]], known: int = 1, workers: Optional[int] = None) -> bool:
         """
         Determine if a given blockchain is valid
 
         :param chain: A blockchain
+        :param known: Length of a prefix of chain that is already known to be valid, eg. the part it
+                      shares with ours; only the blocks after it are checked
+        :param workers: Processes to use, default all cores above PARALLEL_BLOCKS blocks
         :return: True if valid, False if not
         """
 
-        last_block = chain[0]
-        current_index = 1
+        blocks = chain[max(known, 1) - 1:]
+        if workers is None:
+            workers = (os.cpu_count() or 1) if len(blocks) > PARALLEL_BLOCKS else 1
+        if workers <= 1:
+            return _validate_range(blocks)
+
+        # Ranges overlap by one block, so the links between them get checked too
+        size = -(-len(blocks) // workers)
+        ranges = [blocks[i:i + size + 1] for i in range(0, len(blocks) - 1, size)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_process_context) as pool:
+            return all(pool.map(_validate_range, ranges))
+
+    def valid_headers(self, headers: List[Dict[str, Any]], workers: Optional[int] = None) -> bool:
+        """
+        Check the hash links and Proofs of Work of consecutive block headers
 
-        while current_index < len(chain):
-            block = chain[current_index]
-            print(f'{last_block}')
-            print(f'{block}')
-            print("\n-----------\n")
+        :param headers: Headers, see header(), the first one is trusted
+        :param workers: Processes checking the proofs, see valid_proofs()
+        :return: True if valid, False if not
+        """
+
+        for last_header, header in zip(headers, headers[1:]):
             # Check that the hash of the block is correct
-            if block['previous_hash'] != self.hash(last_block):
+            if header['previous_hash'] != last_header['hash']:
                 return False
 
-            # Check that the Proof of Work is correct
-            if not self.valid_proof(last_block['proof'], block['proof']):
-                return False
+        # Check that the Proofs of Work are correct
+        pairs = [(last_header['proof'], header['proof']) for last_header, header in zip(headers, headers[1:])]
+        return self.valid_proofs(pairs, workers)
 
-            last_block = block
-            current_index += 1
+    @staticmethod
+    def valid_proofs(pairs: List[Tuple[int, int]], workers: Optional[int] = None) -> bool:
+        """
+        Validate many Proofs, on a process pool when there are enough of them
+
+        :param pairs: (Previous Proof, Current Proof) of consecutive blocks
+        :param workers: Processes to use, default all cores above PARALLEL_BLOCKS pairs
+        :return: True if all correct, False if not.
+        """
+
+        if workers is None:
+            workers = (os.cpu_count() or 1) if len(pairs) > PARALLEL_BLOCKS else 1
+        if workers <= 1:
+            return _valid_proofs(pairs)
 
-        return True
+        size = -(-len(pairs) // workers)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_process_context) as pool:
+            return all(pool.map(_valid_proofs, [pairs[i:i + size] for i in range(0, len(pairs), size)]))
 
     def resolve_conflicts(self) -> bool:
         """
@@ -65,31 +308,216 @@ class Blockchain:
         :return: True if our chain was replaced, False if not
         """
 
-        neighbours = self.nodes
-        new_chain = None
+        neighbours = list(self.nodes)
+        ancestor = 0
+        new_blocks = None
 
         # We're only looking for chains longer than ours
         max_length = len(self.chain)
 
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
+        # Ask every node for its length first, that is a few bytes instead of a chain
+        tips = []
+        if neighbours:
+            with ThreadPoolExecutor(max_workers=min(self.peer_workers, len(neighbours))) as pool:
+                tips = [tip for tip in pool.map(self._peer_tip, neighbours) if tip is not None]
+
+        # Sync from longer nodes only, longest first, until one gives a valid chain
+        for tip in sorted(tips, key=lambda tip: tip['length'], reverse=True):
+            if tip['length'] <= max_length:
+                break
+
+            synced = self.sync(tip['node'], tip['length'])
+            if synced is not None and synced[0] + len(synced[1]) > max_length:
+                ancestor, new_blocks, new_hashes = synced
+                break
+
+        # Replace our chain after the fork point if we discovered a new, valid chain longer than ours
+        if new_blocks:
+            with self.lock:
+                # We may have mined meanwhile
+                if ancestor + len(new_blocks) <= len(self.chain):
+                    return False
+                # Or lost the fork point to another replacement
+                if ancestor and (ancestor > len(self.chain)
+                                 or self.hashes[ancestor - 1] != new_blocks[0]['previous_hash']):
+                    return False
+                self.chain = self.chain[:ancestor] + new_blocks
+                self.hashes = self.hashes[:ancestor] + new_hashes
+            # A proof for our old tip is worthless now
+            if self.miner is not None:
+                self.miner.cancel()
+            return True
 
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
+        return False
 
-                # Check if the length is longer and the chain is valid
-                if length > max_length and self.valid_chain(chain):
-                    max_length = length
-                    new_chain = chain
+    def _peer_tip(self, node: str) -> Optional[Dict[str, Any]]:
+        """
+        Fetch the length and tip hash of a node
 
-        # Replace our chain if we discovered a new, valid chain longer than ours
-        if new_chain:
-            self.chain = new_chain
-            return True
+        :param node: Address of node. Eg. '192.168.0.5:5000'
+        :return: {'node', 'length', 'hash'}, or None if the node did not answer
+        """
 
-        return False
+        try:
+            response = self.session.get(f'http://{node}/chain/tip', timeout=PEER_TIMEOUT)
+            if response.status_code != 200:
+                return None
+            tip = response.json()
+        except (requests.RequestException, ValueError):
+            return None
+
+        # Valid json is not yet a tip, a broken peer must not fail the whole consensus
+        if not isinstance(tip, dict) or type(tip.get('length')) is not int:
+            return None
+
+        tip['node'] = node
+        return tip
+
+    def _peer_get(self, node: str, path: str, **params) -> Optional[Any]:
+        """
+        GET a json document from a node
+
+        :param node: Address of node. Eg. '192.168.0.5:5000'
+        :param path: Eg. '/chain/headers'
+        :return: The decoded document, or None if the node did not answer
+        """
+
+        try:
+            response = self.session.get(f'http://{node}{path}', params=params, timeout=CHAIN_TIMEOUT)
+            if response.status_code != 200:
+                return None
+            return response.json()
+        except (requests.RequestException, ValueError):
+            return None
+
+    def locator(self) -> List[Dict[str, Any]]:
+        """
+        Sample our chain from the tip back: the last 10 blocks, then exponentially sparser
+
+        :return: [{'index', 'hash'}, ...], newest first, always ending with the genesis block
+        """
+
+        with self.lock:
+            chain = self.chain
+            entries = []
+            position = len(chain) - 1
+            step = 1
+            while position > 0:
+                entries.append({'index': chain[position]['index'], 'hash': self.hashes[position]})
+                if len(entries) >= 10:
+                    step *= 2
+                position -= step
+            entries.append({'index': chain[0]['index'], 'hash': self.hashes[0]})
+            return entries
+
+    def find_ancestor(self, locator: List[Dict[str, Any]]) -> int:
+        """
+        Find the newest block of a locator that is also in our chain
+
+        :param locator: A locator from another node, see locator(), malformed entries are skipped
+        :return: Index of the common block, 0 if the chains share nothing
+        """
+
+        with self.lock:
+            for entry in locator:
+                if not _has_types(entry, LOCATOR_TYPES):
+                    continue
+                index = entry['index']
+                if 1 <= index <= len(self.chain) and self.hashes[index - 1] == entry['hash']:
+                    return index
+            return 0
+
+    @staticmethod
+    def header(block: Dict[str, Any], block_hash: Optional[str] = None) -> Dict[str, Any]:
+        """
+        The part of a Block needed to check links and Proof of Work
+
+        :param block: Block
+        :param block_hash: hash(block) if it is already known
+        """
+
+        return {
+            'index': block['index'],
+            'hash': block_hash or Blockchain.hash(block),
+            'previous_hash': block['previous_hash'],
+            'proof': block['proof'],
+        }
+
+    def sync(self, node: str, length: int) -> Optional[Tuple[int, List[Dict[str, Any]], List[str]]]:
+        """
+        Download the part of a node's chain we don't have, headers first
+
+        Finds the fork point with our locator, fetches and checks the headers
+        after it, then the blocks themselves in parallel ranges, which are
+        validated with valid_chain(known=fork point).
+
+        :param node: Address of node. Eg. '192.168.0.5:5000'
+        :param length: Length of the node's chain, from its tip
+        :return: (index of the fork point, the node's blocks after it, their hashes),
+                 or None if the node did not answer or sent an invalid chain
+        """
+
+        try:
+            response = self.session.post(f'http://{node}/chain/ancestor', json={'locator': self.locator()},
+                                         timeout=PEER_TIMEOUT)
+            if response.status_code != 200:
+                return None
+            answer = response.json()
+        except (requests.RequestException, ValueError):
+            return None
+        if not _has_types(answer, {'index': int}):
+            return None
+        ancestor = answer['index']
+
+        with self.lock:
+            if not 0 <= ancestor <= len(self.chain):
+                return None
+            prefix = self.chain[:ancestor]
+            last = [self.header(self.chain[ancestor - 1], self.hashes[ancestor - 1])] if ancestor else []
+
+        # Headers are small, check the links and proofs before downloading any block
+        headers = []
+        while ancestor + len(headers) < length:
+            start = ancestor + len(headers) + 1
+            page = self._peer_get(node, '/chain/headers', start=start, count=MAX_HEADERS)
+            if not isinstance(page, dict) or not isinstance(page.get('headers'), list) or not page['headers']:
+                return None
+            for header in page['headers']:
+                # Headers must come in order, starting right after the fork point
+                if not _has_types(header, HEADER_TYPES) or header['index'] != ancestor + len(headers) + 1:
+                    return None
+                headers.append(header)
+
+        if not self.valid_headers(last + headers):
+            return None
+
+        # Fetch the blocks range by range, each one must match its header
+        starts = range(ancestor + 1, ancestor + len(headers) + 1, MAX_BLOCKS)
+        with ThreadPoolExecutor(max_workers=min(self.peer_workers, len(starts)) or 1) as pool:
+            pages = list(pool.map(lambda start: self._peer_get(node, '/chain/blocks', start=start, count=MAX_BLOCKS),
+                                  starts))
+
+        blocks = []
+        for page in pages:
+            if not isinstance(page, dict) or not isinstance(page.get('blocks'), list):
+                return None
+            blocks.extend(page['blocks'])
+        if len(blocks) < len(headers):
+            return None
+
+        for block, header in zip(blocks, headers):
+            # The header chain is checked, the block has to be exactly the one it describes
+            if not isinstance(block, dict) or self.hash(block) != header['hash']:
+                return None
+            if any(block.get(key) != header[key] for key in ('index', 'previous_hash', 'proof')):
+                return None
+
+        # The blocks themselves, not just their headers: only the suffix after our shared prefix is checked
+        blocks = blocks[:len(headers)]
+        if not self.valid_chain(prefix + blocks, known=ancestor):
+            return None
+
+        return ancestor, blocks, [header['hash'] for header in headers]
 
     def new_block(self, proof: int, previous_hash: Optional[str]) -> Dict[str, Any]:
         """
@@ -100,19 +528,21 @@ class Blockchain:
         :return: New Block
         """
 
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-        }
+        with self.lock:
+            block = {
+                'index': len(self.chain) + 1,
+                'timestamp': time(),
+                'transactions': self.current_transactions,
+                'proof': proof,
+                'previous_hash': previous_hash or self.hashes[-1],
+            }
 
-        # Reset the current list of transactions
-        self.current_transactions = []
+            # Reset the current list of transactions
+            self.current_transactions = []
 
-        self.chain.append(block)
-        return block
+            self.chain.append(block)
+            self.hashes.append(self.hash(block))
+            return block
 
     def new_transaction(self, sender: str, recipient: str, amount: int) -> int:
         """
@@ -123,13 +553,14 @@ class Blockchain:
         :param amount: Amount
         :return: The index of the Block that will hold this transaction
         """
-        self.current_transactions.append({
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount,
-        })
+        with self.lock:
+            self.current_transactions.append({
+                'sender': sender,
+                'recipient': recipient,
+                'amount': amount,
+            })
 
-        return self.last_block['index'] + 1
+            return self.last_block['index'] + 1
 
     @property
     def last_block(self) -> Dict[str, Any]:
@@ -144,16 +575,21 @@ class Blockchain:
         """
 
         # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
-        block_string = json.dumps(block, sort_keys=True).encode()
+        block_string = _canonical_json.encode(block).encode()
         return hashlib.sha256(block_string).hexdigest()
 
-    def proof_of_work(self, last_proof: int) -> int:
+    def proof_of_work(self, last_proof: int) -> Optional[int]:
         """
         Simple Proof of Work Algorithm:
          - Find a number p' such that hash(pp') contains leading 4 zeroes, where p is the previous p'
          - p is the previous proof, and p' is the new proof
+
+        With a miner the search runs on all cores and returns None when cancelled.
         """
 
+        if self.miner is not None:
+            return self.miner.mine(last_proof)
+
         proof = 0
         while self.valid_proof(last_proof, proof) is False:
             proof += 1
@@ -171,8 +607,113 @@ class Blockchain:
         """
 
         guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        # Compare the raw digest, four leading hex zeroes are the first 16 bits
+        return hashlib.sha256(guess).digest() < PROOF_TARGET
+
+
+class MiningJobs:
+    """
+    Mining requests served by one background thread
+
+    submit() returns a job id at once, the worker mines on the current tip and
+    starts over when the tip changes under it (e.g. consensus replaced our chain).
+    """
+
+    def __init__(self, blockchain: Blockchain, recipient: str, history: int = 1000):
+        self.blockchain = blockchain
+        self.recipient = recipient
+        self.history = history
+        self.jobs: Dict[str, Dict[str, Any]] = OrderedDict()
+        self.queue: queue.Queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def submit(self) -> Dict[str, Any]:
+        """
+        Queue a new block to be mined
+
+        :return: The job status
+        """
+
+        job = {
+            'id': uuid4().hex,
+            'status': 'queued',
+            'created': time(),
+        }
+        with self.lock:
+            self.jobs[job['id']] = job
+            # Forget the oldest finished jobs
+            while len(self.jobs) > self.history:
+                oldest = next(iter(self.jobs.values()))
+                if oldest['status'] not in ('done', 'failed'):
+                    break
+                self.jobs.pop(oldest['id'])
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, name='miner', daemon=True)
+                self.worker.start()
+        self.queue.put(job['id'])
+        return dict(job)
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def _update(self, job_id: str, **values) -> None:
+        with self.lock:
+            self.jobs[job_id].update(values)
+
+    def _mine(self) -> Dict[str, Any]:
+        """
+        Mine one block on the current tip, retrying until it is still the tip
+
+        :return: The new Block
+        """
+
+        blockchain = self.blockchain
+        while True:
+            last_block = blockchain.last_block
+            proof = blockchain.proof_of_work(last_block['proof'])
+            if proof is None:
+                continue
+
+            with blockchain.lock:
+                if blockchain.last_block is not last_block:
+                    continue
+
+                # We must receive a reward for finding the proof.
+                # The sender is "0" to signify that this node has mined a new coin.
+                blockchain.new_transaction(
+                    sender="0",
+                    recipient=self.recipient,
+                    amount=1,
+                )
+
+                # Forge the new Block by adding it to the chain
+                return blockchain.new_block(proof, blockchain.hashes[-1])
+
+    def _run(self) -> None:
+        while True:
+            job_id = self.queue.get()
+            self._update(job_id, status='mining', started=time())
+            try:
+                block = self._mine()
+            except Exception as e:
+                self._update(job_id, status='failed', error=str(e), finished=time())
+                continue
+
+            miner = self.blockchain.miner
+            report = miner.last_report if miner is not None else {}
+            self._update(
+                job_id,
+                status='done',
+                finished=time(),
+                index=block['index'],
+                proof=block['proof'],
+                previous_hash=block['previous_hash'],
+                transactions=block['transactions'],
+                hashes_per_s=report.get('hashes_per_s'),
+            )
 
 
 # Instantiate the Node
@@ -181,36 +722,34 @@ app = Flask(__name__)
 # Generate a globally unique address for this node
 node_identifier = str(uuid4()).replace('-', '')
 
-# Instantiate the Blockchain
-blockchain = Blockchain()
+# Instantiate the Blockchain, its process pool only starts with the first /mine
+blockchain = Blockchain(miner=ProofOfWorkMiner())
+
+# Mining runs in the background, /mine only queues a job
+mining_jobs = MiningJobs(blockchain, node_identifier)
 
 
 @app.route('/mine', methods=['GET'])
 def mine():
-    # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    last_proof = last_block['proof']
-    proof = blockchain.proof_of_work(last_proof)
-
-    # We must receive a reward for finding the proof.
-    # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction(
-        sender="0",
-        recipient=node_identifier,
-        amount=1,
-    )
-
-    # Forge the new Block by adding it to the chain
-    block = blockchain.new_block(proof, last_block['previous_hash'])
+    job = mining_jobs.submit()
 
     response = {
-        'message': "New Block Forged",
-        'index': block['index'],
-        'transactions': block['transactions'],
-        'proof': block['proof'],
-        'previous_hash': block['previous_hash'],
+        'message': "Mining job queued",
+        'job': job,
+        'status_url': f'/mine/{job["id"]}',
     }
-    return jsonify(response), 200
+    return jsonify(response), 202
+
+
+@app.route('/mine/<job_id>', methods=['GET'])
+def mine_status(job_id: str):
+    job = mining_jobs.status(job_id)
+    if job is None:
+        return 'Unknown mining job', 404
+
+    if job['status'] == 'done':
+        job['message'] = "New Block Forged"
+    return jsonify(job), 200
 
 
 @app.route('/transactions/new', methods=['POST'])
@@ -238,6 +777,73 @@ def full_chain():
     return jsonify(response), 200
 
 
+@app.route('/chain/tip', methods=['GET'])
+def chain_tip():
+    with blockchain.lock:
+        response = {
+            'length': len(blockchain.chain),
+            'hash': blockchain.hashes[-1],
+        }
+    return jsonify(response), 200
+
+
+def _range_arguments(limit: int) -> Tuple[int, int]:
+    """
+    Read the start (block index, from 1) and count query arguments
+
+    :param limit: Largest count handed out
+    """
+
+    start = max(request.args.get('start', 1, type=int), 1)
+    count = min(max(request.args.get('count', limit, type=int), 0), limit)
+    return start, count
+
+
+@app.route('/chain/headers', methods=['GET'])
+def chain_headers():
+    start, count = _range_arguments(MAX_HEADERS)
+    with blockchain.lock:
+        blocks = blockchain.chain[start - 1:start - 1 + count]
+        hashes = blockchain.hashes[start - 1:start - 1 + count]
+        length = len(blockchain.chain)
+
+    response = {
+        'headers': [blockchain.header(block, block_hash) for block, block_hash in zip(blocks, hashes)],
+        'length': length,
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/blocks', methods=['GET'])
+def chain_blocks():
+    start, count = _range_arguments(MAX_BLOCKS)
+    with blockchain.lock:
+        blocks = blockchain.chain[start - 1:start - 1 + count]
+        length = len(blockchain.chain)
+
+    response = {
+        'blocks': blocks,
+        'length': length,
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/ancestor', methods=['POST'])
+def chain_ancestor():
+    values = request.get_json()
+
+    locator = values.get('locator') if isinstance(values, dict) else None
+    if not isinstance(locator, list) or not all(_has_types(entry, LOCATOR_TYPES) for entry in locator):
+        return "Error: Please supply a block locator", 400
+
+    index = blockchain.find_ancestor(locator)
+    response = {
+        'index': index,
+        'length': len(blockchain.chain),
+    }
+    return jsonify(response), 200
+
+
 @app.route('/nodes/register', methods=['POST'])
 def register_nodes():
     values = request.get_json()
@@ -275,11 +881,20 @@ def consensus():
 
 
 if __name__ == '__main__':
+    import signal
+    import sys
     from argparse import ArgumentParser
 
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='mining processes, default all cores')
     args = parser.parse_args()
     port = args.port
-
-    app.run(host='0.0.0.0', port=port)
+    blockchain.miner.workers = args.workers or blockchain.miner.workers
+
+    # SIGTERM unwinds like Ctrl-C, so the mining workers are shut down with the node
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        app.run(host='0.0.0.0', port=port)
+    finally:
+        blockchain.miner.close()
@@ -0,0 +1,97 @@
+'''-*- coding: utf-8 -*-'''
+
+import os
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+import blockchain
+import compact
+
+"""
+Chain benchmarks on the ling-spam mails (or synthetic ones).
+
+	python bench_chain.py ingest -n 100000
+	python bench_chain.py memory -n 1000000
+"""
+
+TRAIN_DIR = os.path.join('..', 'Mail-Spam-Filtering-master', 'Mail-Spam-Filtering-master', 'ling-spam', 'train-mails')
+
+
+def load_mails(count):
+	""" count mails, the ling-spam train set repeated, or synthetic text without it. """
+	mails = []
+	if os.path.isdir(TRAIN_DIR):
+		for f in sorted(os.listdir(TRAIN_DIR)):
+			with open(os.path.join(TRAIN_DIR, f)) as file:
+				mails.append(file.read())
+	if not mails:
+		mails = ['Subject: mail %d\n\nsynthetic mail body %d\n' % (i, i) for i in range(1000)]
+	return [mails[i % len(mails)] + str(i) for i in range(count)]
+
+def bench_ingest(count):
+	mails = load_mails(count)
+
+	chain = blockchain.Chain()
+	start = time.perf_counter()
+	for mail in mails:
+		block = blockchain.Block()
+		block.add_message(blockchain.Email_Content(mail))
+		chain.add_block(block)
+	single = time.perf_counter() - start
+
+	chain = blockchain.Chain()
+	start = time.perf_counter()
+	for mail in mails:
+		chain.ingest(blockchain.Email_Content(mail))
+	chain.flush_ingest()
+	batched = time.perf_counter() - start
+
+	print('block per mail : %8.0f mails/s' % (count / single))
+	print('batched ingest : %8.0f mails/s (%d blocks)' % (count / batched, len(chain.chain)))
+
+def _traced_bytes(build):
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	result = build()
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return result, after - before
+
+def bench_memory(count):
+	""" Bytes per message held by the chain, mail texts are shared by all forms. """
+	mails = ['mail body %d' % i for i in range(count)]
+
+	def build_blocks():
+		#built without Chain, its lookup index is not part of the representation
+		blocks = []
+		for i in range(0, count, 100):
+			block = blockchain.Block()
+			block.add_messages([blockchain.Email_Content(mail) for mail in mails[i:i + 100]])
+			if blocks:
+				block.link(blocks[-1])
+			block.seal()
+			blocks.append(block)
+		return blocks
+	blocks, full = _traced_bytes(build_blocks)
+
+	compact_blocks, slim = _traced_bytes(lambda: [compact.CompactBlock.from_block(b) for b in blocks])
+	del compact_blocks
+	#the offloaded content lives elsewhere (e.g. on disk), fill the mapping before tracing
+	offload = dict((m.content_hash, m.content) for b in blocks for m in b.messages)
+	compact_blocks, offloaded = _traced_bytes(lambda: [compact.CompactBlock.from_block(b, offload) for b in blocks])
+
+	print('Email_Content/Block       : %6.0f bytes/message' % (full / count))
+	print('CompactMessage/Block      : %6.0f bytes/message' % (slim / count))
+	print('Compact, content offloaded: %6.0f bytes/message' % (offloaded / count))
+
+if __name__ == '__main__':
+	parser = ArgumentParser()
+	parser.add_argument('bench', choices = ['ingest', 'memory'])
+	parser.add_argument('-n', '--count', default = 100000, type = int)
+	args = parser.parse_args()
+
+	if args.bench == 'ingest':
+		bench_ingest(args.count)
+	elif args.bench == 'memory':
+		bench_memory(args.count)
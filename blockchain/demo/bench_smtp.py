@@ -0,0 +1,135 @@
+'''-*- coding: utf-8 -*-'''
+
+import socket
+import threading
+import socketserver
+from argparse import ArgumentParser
+
+import email_track
+
+"""
+bulk_send_email against a local SMTP stand-in, no mail leaves the machine.
+
+	python bench_smtp.py -n 1000
+
+The stand-in speaks the plain SMTP subset smtplib needs (no STARTTLS, no
+AUTH), drops every session after drop_every messages and refuses recipients
+starting with 'reject', so reconnects and failures are exercised as well.
+"""
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+	"""In-process SMTP sink in the spirit of aiosmtpd's Sink handler."""
+	allow_reuse_address = True
+	daemon_threads = True
+	request_queue_size = 128
+
+	def __init__(self, drop_every = 0):
+		socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), _SMTPHandler)
+		self.drop_every = drop_every
+		self.lock = threading.Lock()
+		self.received = 0
+		self.sessions = 0
+		self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+		self.thread.start()
+
+	@property
+	def port(self):
+		return self.server_address[1]
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+	def reply(self, line):
+		self.wfile.write(line + b'\r\n')
+		self.wfile.flush()
+
+	def handle(self):
+		server = self.server
+		with server.lock:
+			server.sessions += 1
+		self.reply(b'220 stand-in ESMTP')
+		in_data = False
+		count = 0
+		for line in self.rfile:
+			if in_data:
+				if line == b'.\r\n':
+					in_data = False
+					count += 1
+					with server.lock:
+						server.received += 1
+					self.reply(b'250 queued')
+					if server.drop_every and count % server.drop_every == 0:
+						return	#drop the session without a goodbye
+				continue
+			command = line[:4].upper()
+			if command in (b'EHLO', b'HELO'):
+				self.reply(b'250 stand-in')
+			elif command == b'RCPT':
+				if line[8:].strip(b' <').lower().startswith(b'reject'):
+					self.reply(b'550 no such user')
+				else:
+					self.reply(b'250 ok')
+			elif command == b'DATA':
+				in_data = True
+				self.reply(b'354 end with <CRLF>.<CRLF>')
+			elif command == b'QUIT':
+				self.reply(b'221 bye')
+				return
+			else:
+				self.reply(b'250 ok')
+
+
+def free_port():
+	""" A port nothing listens on, for the server-down case. """
+	s = socket.socket()
+	s.bind(('127.0.0.1', 0))
+	port = s.getsockname()[1]
+	s.close()
+	return port
+
+def run(sender, count, rejected = 0):
+	messages = []
+	for i in range(count):
+		to_addr = 'reject%d@example.org' % i if i < rejected else 'user%d@example.org' % i
+		messages.append((to_addr, sender.create_message(to_addr, 'bulk message %d' % i)))
+	report = sender.send(messages)
+	sender.close()
+	return report
+
+def harness(count, pool_size = 4):
+	""" Run every case, fail loudly on a wrong count. """
+	server = SMTPStandIn()
+	sender = email_track.bulk_send_email('me@example.org', None, '127.0.0.1', server.port,
+		pool_size = pool_size, starttls = False)
+	report = run(sender, count)
+	assert report['sent'] == count and not report['failed'], report
+	assert server.sessions == pool_size, server.sessions
+	print('plain         : %(sent)d sent, %(messages_per_s).0f messages/s' % report)
+	server.stop()
+
+	server = SMTPStandIn(drop_every = 50)
+	sender = email_track.bulk_send_email('me@example.org', None, '127.0.0.1', server.port,
+		pool_size = pool_size, starttls = False)
+	report = run(sender, count, rejected = 10)
+	assert report['sent'] == count - 10 and len(report['failed']) == 10, report
+	print('drops+rejects : %(sent)d sent, %(messages_per_s).0f messages/s' % report,
+		'%d failed, %d sessions' % (len(report['failed']), server.sessions))
+	server.stop()
+
+	sender = email_track.bulk_send_email('me@example.org', None, '127.0.0.1', free_port(),
+		pool_size = pool_size, starttls = False, timeout = 2)
+	report = run(sender, 20)
+	assert report['sent'] == 0 and len(report['failed']) == 20 and sender.sessions.empty(), report
+	print('server down   : %d failed, no session pooled' % len(report['failed']))
+
+if __name__ == '__main__':
+	parser = ArgumentParser()
+	parser.add_argument('-n', '--count', default = 1000, type = int)
+	parser.add_argument('-p', '--pool-size', default = 4, type = int)
+	args = parser.parse_args()
+
+	harness(args.count, args.pool_size)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import platform
+import tracemalloc
+from argparse import ArgumentParser
+
+import numpy as np
+
+import spam_filter
+
+'''
+Spam filter benchmarks on the bundled ling-spam corpus.
+
+    python bench_spam.py features
+    python bench_spam.py judge -n 100000
+    python bench_spam.py suite -o results.json
+'''
+
+LING_SPAM = os.path.join('..', 'Mail-Spam-Filtering-master', 'Mail-Spam-Filtering-master', 'ling-spam')
+TRAIN_DIR = os.path.join(LING_SPAM, 'train-mails')
+TEST_DIR = os.path.join(LING_SPAM, 'test-mails')
+
+
+#the nested dictionary loop spam_filter used before, kept as the baseline
+def extract_features_loop(mail_dir, dictionary):
+    files = [os.path.join(mail_dir,fi) for fi in os.listdir(mail_dir)]
+    features_matrix = np.zeros((len(files),3000))
+    docID = 0;
+    for fil in files:
+      with open(fil) as fi:
+        for i,line in enumerate(fi):
+          if i == 2:
+            words = line.split()
+            for word in words:
+              wordID = 0
+              for i,d in enumerate(dictionary):
+                if d[0] == word:
+                  wordID = i
+                  features_matrix[docID,wordID] = words.count(word)
+        docID = docID + 1
+    return features_matrix
+
+def bench_features():
+    dictionary = spam_filter.make_Dictionary(TRAIN_DIR)
+
+    start = time.perf_counter()
+    loop_matrix = extract_features_loop(TRAIN_DIR, dictionary)
+    loop = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sparse_matrix = spam_filter.extract_features_sparse(TRAIN_DIR, dictionary)
+    sparse = time.perf_counter() - start
+
+    assert (sparse_matrix.toarray() == loop_matrix).all()
+    print('nested loop    : %8.3f s' % loop)
+    print('vocabulary CSR : %8.3f s (%.0fx, %d non-zeros)' % (sparse, loop / sparse, sparse_matrix.nnz))
+
+def load_mails(mail_dir, count):
+    files = sorted(os.listdir(mail_dir))
+    mails = []
+    for f in files:
+        with open(os.path.join(mail_dir, f)) as m:
+            mails.append(m.read())
+    return [mails[i % len(mails)] for i in range(count)]
+
+def bench_judge(count):
+    model, dictionary = spam_filter.load_or_train('spam_model', TRAIN_DIR)
+    mails = load_mails(TEST_DIR, count)
+
+    #one judge() per mail on a sample, it is too slow for all of them
+    sample = mails[:min(count, 2000)]
+    start = time.perf_counter()
+    for mail in sample:
+        spam_filter.judge(mail, model, dictionary)
+    single = (time.perf_counter() - start) / len(sample)
+
+    start = time.perf_counter()
+    probabilities = spam_filter.judge_batch(mails, model, dictionary)
+    batch = time.perf_counter() - start
+
+    print('judge per mail : %8.0f mails/s' % (1 / single))
+    print('judge_batch    : %8.0f mails/s (%d mails, %d spam)' % (count / batch, count, (probabilities >= 0.5).sum()))
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+#peak bytes allocated while fn runs, in its own run: tracing slows everything down
+def _peak_bytes(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def _percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {'p50_ms': float(np.percentile(samples, 50)), 'p99_ms': float(np.percentile(samples, 99)),
+            'mean_ms': float(samples.mean())}
+
+#peak resident set size, None where the resource module is missing (Windows)
+def _max_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    #ru_maxrss is KB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def bench_suite(count = 10000, repeat = 5):
+    """ Every spam filter stage on ling-spam, as one json-able dict. """
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'count': count,
+        'stages': {},
+    }
+    stages = results['stages']
+
+    def best_of(name, fn):
+        runs = [_timed(fn) for i in range(repeat)]
+        result, seconds = min(runs, key = lambda r: r[1])
+        stages[name] = {'seconds': seconds, 'peak_bytes': _peak_bytes(fn)}
+        return result
+
+    dictionary = best_of('dictionary', lambda: spam_filter.make_Dictionary(TRAIN_DIR, processes = 1))
+    files = [os.path.join(TRAIN_DIR, f) for f in os.listdir(TRAIN_DIR)]
+    train_matrix = best_of('features', lambda: spam_filter.extract_features_sparse(TRAIN_DIR, dictionary))
+    stages['features']['mails_per_s'] = len(files) / stages['features']['seconds']
+    labels = spam_filter.mail_labels(files)
+    model = best_of('train', lambda: spam_filter.MultinomialNB().fit(train_matrix, labels))
+
+    mails = load_mails(TEST_DIR, count)
+    latencies = []
+    for mail in mails[:min(count, 2000)]:
+        start = time.perf_counter()
+        spam_filter.judge(mail, model, dictionary)
+        latencies.append(time.perf_counter() - start)
+    stages['judge'] = _percentiles(latencies)
+
+    vocabulary = spam_filter.make_vocabulary(dictionary)
+    batch_latencies = []
+    for i in range(0, len(mails), 1000):
+        start = time.perf_counter()
+        spam_filter.judge_batch(mails[i:i + 1000], model, dictionary, vocabulary)
+        batch_latencies.append(time.perf_counter() - start)
+    stages['judge_batch_1000'] = _percentiles(batch_latencies)
+    stages['judge_batch_1000']['mails_per_s'] = len(mails) / sum(batch_latencies)
+
+    results['max_rss_bytes'] = _max_rss_bytes()
+    return results
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('bench', choices = ['features', 'judge', 'suite'])
+    parser.add_argument('-n', '--count', default = 100000, type = int)
+    parser.add_argument('-o', '--output', default = None, help = 'json file for the suite results')
+    args = parser.parse_args()
+
+    if args.bench == 'features':
+        bench_features()
+    elif args.bench == 'judge':
+        bench_judge(args.count)
+    elif args.bench == 'suite':
+        #judged mails are held in memory, the suite stops at 10000; 'count' in the json says how many
+        results = bench_suite(min(args.count, 10000))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent = 2)
+        else:
+            print(json.dumps(results, indent = 2))
@@ -0,0 +1,163 @@
+'''-*- coding: utf-8 -*-'''
+
+import os
+import json
+import hashlib
+
+"""
+Content-addressed, deduplicating store for mail payloads.
+
+A blob is stored once under its hash and reference counted. Mail bodies are
+keyed by Email_Content.content_hash, attachments by the sha256 of their bytes,
+so a mailing-list post landing in many blocks is kept and hashed only once.
+
+	<dir>/ab/abcdef....blob		one file per blob: [kind][data]
+	<dir>/refs.json				reference counts and byte totals, written on flush()
+"""
+
+
+def _pack(value):
+	if isinstance(value, (bytes, bytearray, memoryview)):
+		return b'b' + bytes(value)
+	if isinstance(value, str):
+		return b's' + value.encode('utf-8')
+	return b'j' + json.dumps(value, separators = (',', ':')).encode('utf-8')
+
+def _unpack(data):
+	kind, data = data[:1], data[1:]
+	if kind == b'b':
+		return data
+	if kind == b's':
+		return data.decode('utf-8')
+	return json.loads(data.decode('utf-8'))
+
+
+class BlobStore(object):
+	"""Reference counted blobs keyed by their content hash.
+
+		directory: where to keep the blobs, None keeps them in memory.
+		The store is also a mapping (store[key] = value, store[key]), so it
+		can be used as the offload target of compact.CompactMessage.
+	"""
+	def __init__(self, directory = None):
+		super(BlobStore, self).__init__()
+		self.directory = directory
+		self.blobs = {}		#in-memory blobs
+		self.refs = {}		#key --> reference count
+		self.logical_bytes = 0	#bytes put, duplicates included
+		self.stored_bytes = 0	#bytes actually kept
+		self.unsynced = []	#blob files written since the last flush()
+		if directory is not None:
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			refs_path = os.path.join(directory, 'refs.json')
+			if os.path.exists(refs_path):
+				with open(refs_path) as f:
+					state = json.load(f)
+				self.refs = state['refs']
+				self.logical_bytes = state['logical_bytes']
+				self.stored_bytes = state['stored_bytes']
+
+	def _path(self, key):
+		return os.path.join(self.directory, key[:2], key + '.blob')
+
+	def put(self, value, key = None):
+		""" Store value (str, bytes or json data) and return its key.
+
+			key defaults to the sha256 of the stored bytes plus their kind, so an
+			attachment never shares a key with a text mail keyed by content_hash
+			(the sha256 of the same bytes); a known key only gets its reference
+			count raised, the value is not written again.
+		"""
+		data = _pack(value)
+		if key is None:
+			key = hashlib.sha256(data[1:]).hexdigest() + '-' + data[:1].decode('ascii')
+		self.logical_bytes += len(data)
+		if key in self.refs:
+			self.refs[key] += 1
+			return key
+		self.refs[key] = 1
+		self.stored_bytes += len(data)
+		if self.directory is None:
+			self.blobs[key] = data
+		else:
+			path = self._path(key)
+			#written before an unclean exit lost refs.json, the bytes are the same
+			if os.path.exists(path):
+				return key
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			with open(path, 'wb') as f:
+				f.write(data)
+			self.unsynced.append(path)
+		return key
+
+	def get(self, key):
+		if self.directory is None:
+			if key not in self.refs:
+				raise KeyError(key)
+			return _unpack(self.blobs[key])
+		#the blob file, not refs: refs.json lags behind it until flush()
+		try:
+			with open(self._path(key), 'rb') as f:
+				return _unpack(f.read())
+		except FileNotFoundError:
+			raise KeyError(key)
+
+	def release(self, key):
+		""" Drop one reference, the blob is deleted with the last one. """
+		if self.directory is None:
+			size = len(self.blobs[key])
+		else:
+			size = os.path.getsize(self._path(key))
+		self.logical_bytes -= size
+		self.refs[key] -= 1
+		if self.refs[key] > 0:
+			return
+		del self.refs[key]
+		self.stored_bytes -= size
+		if self.directory is None:
+			del self.blobs[key]
+		else:
+			os.remove(self._path(key))
+
+	def dedup_ratio(self):
+		""" Bytes put / bytes stored, 1.0 means no duplicates. """
+		if not self.stored_bytes:
+			return 1.0
+		return self.logical_bytes / float(self.stored_bytes)
+
+	def __contains__(self, key):
+		if self.directory is None:
+			return key in self.refs
+		return key in self.refs or os.path.exists(self._path(key))
+
+	def __setitem__(self, key, value):
+		self.put(value, key)
+
+	def __getitem__(self, key):
+		return self.get(key)
+
+	def __len__(self):
+		return len(self.refs)
+
+	def flush(self):
+		""" fsync the new blobs, then the reference counts. """
+		if self.directory is None:
+			return
+		for blob_path in self.unsynced:
+			with open(blob_path, 'rb') as f:
+				os.fsync(f.fileno())
+		self.unsynced = []
+		path = os.path.join(self.directory, 'refs.json')
+		with open(path + '.tmp', 'w') as f:
+			json.dump({'refs': self.refs, 'logical_bytes': self.logical_bytes,
+				'stored_bytes': self.stored_bytes}, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(path + '.tmp', path)
+
+	def __repr__(self):
+		return 'BlobStore<blobs: {}, stored: {} bytes, dedup ratio: {:.2f}>'.format(
+			len(self.refs), self.stored_bytes, self.dedup_ratio()
+		)
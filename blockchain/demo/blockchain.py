@@ -1,11 +1,49 @@
 import json
 import hashlib
+import struct
 import time
 import datetime
 import email_track
 
 import poplib
 
+HASH_CHUNK = 1 << 20	#bytes/characters fed to the hasher at once
+
+def _update_text(hasher, text):
+	""" Same digest as hashing text.encode('utf-8'), without encoding it all at once. """
+	for i in range(0, len(text), HASH_CHUNK):
+		hasher.update(text[i:i + HASH_CHUNK].encode('utf-8'))
+
+def _update_chunks(hasher, tag, chunks):
+	hasher.update(tag)
+	for chunk in chunks:
+		hasher.update(struct.pack('<I', len(chunk)))
+		hasher.update(chunk)
+	hasher.update(struct.pack('<I', 0))
+
+def _update_framed(hasher, value):
+	""" Canonical framing of decoded email content (lists of text and attachments).
+
+		str:	b's' ([u32 length][utf-8 chunk])... [u32 0]
+		bytes:	b'b' ([u32 length][chunk])... [u32 0]
+		list:	b'l' [u64 count] items...
+		None:	b'n'
+	"""
+	if isinstance(value, str):
+		_update_chunks(hasher, b's', (value[i:i + HASH_CHUNK].encode('utf-8')
+			for i in range(0, len(value), HASH_CHUNK)))
+	elif isinstance(value, (bytes, bytearray, memoryview)):
+		view = memoryview(value).cast('B')
+		_update_chunks(hasher, b'b', (view[i:i + HASH_CHUNK] for i in range(0, len(view), HASH_CHUNK)))
+	elif isinstance(value, (list, tuple)):
+		hasher.update(b'l' + struct.pack('<Q', len(value)))
+		for item in value:
+			_update_framed(hasher, item)
+	elif value is None:
+		hasher.update(b'n')
+	else:
+		_update_framed(hasher, str(value))
+
 class Email_Content(object):
 	"""docstring for email_content"""
 	def __init__(self, content):
@@ -21,7 +59,15 @@ class Email_Content(object):
 		self.size = self.get_size 	#length in bytes
 
 	def _hash_content(self, content):
-		return hashlib.sha256(bytearray(content, 'utf-8')).hexdigest()
+		""" Text mails hash as their utf-8 bytes, decoded mails (lists with
+			attachment bytes) through the canonical framing; both are streamed.
+		"""
+		hasher = hashlib.sha256()
+		if isinstance(content, str):
+			_update_text(hasher, content)
+		else:
+			_update_framed(hasher, content)
+		return hasher.hexdigest()
 		
 	def get_size(self, content):
 		size = 0
@@ -30,7 +76,17 @@ class Email_Content(object):
 		return size
 		
 	def _hash_payload(self):
-		return hashlib.sha256(bytearray(str(self.timestamp) + str(self.content) + str(self.id), "utf-8")).hexdigest()
+		hasher = hashlib.sha256()
+		if isinstance(self.content, str):
+			#timestamp + content + id, as one string before
+			_update_text(hasher, str(self.timestamp))
+			_update_text(hasher, self.content)
+			_update_text(hasher, self.id)
+		else:
+			_update_framed(hasher, self.timestamp)
+			_update_framed(hasher, self.content)
+			_update_framed(hasher, self.id)
+		return hasher.hexdigest()
 
 	def _hash_message(self):
 		return hashlib.sha256(bytearray(str(self.pre_hash) + self.payload_hash, "utf-8")).hexdigest()
@@ -53,19 +109,75 @@ class Email_Content(object):
 			self.hash, self.pre_hash, self.content[:20]
 		)
 
+#merkle tree over the message hashes, leaves and nodes are domain separated
+def _merkle_leaf(message_hash):
+	return hashlib.sha256(b'\x00' + bytes.fromhex(message_hash)).digest()
+
+def _merkle_node(left, right):
+	return hashlib.sha256(b'\x01' + left + right).digest()
+
+def _merkle_levels(message_hashes):
+	""" All levels of the tree, leaves first. An odd node is carried up unchanged. """
+	level = [_merkle_leaf(h) for h in message_hashes]
+	levels = [level]
+	while len(level) > 1:
+		level = [_merkle_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+			for i in range(0, len(level), 2)]
+		levels.append(level)
+	return levels
+
+def merkle_root(message_hashes):
+	return _merkle_levels(message_hashes)[-1][0].hex()
+
+def verify_proof(message_hash, proof, root):
+	""" Check a Block.proof_for() proof: True if message_hash is under root. """
+	node = _merkle_leaf(message_hash)
+	for sibling, side in proof:
+		if side == 'L':
+			node = _merkle_node(bytes.fromhex(sibling), node)
+		else:
+			node = _merkle_node(node, bytes.fromhex(sibling))
+	return node.hex() == root
+
 #block object
 class Block(object):
 	"""docstring for block"""
-	def __init__(self):
+	def __init__(self, merkle = False):
+		""" merkle: hash the block over the merkle root of its messages, so a
+			single message can be proven with proof_for().
+		"""
 		super(Block, self).__init__()
 		self.messages = []
 		self.timestamp = None
 		self.hash = None
 		self.pre_hash = None
+		self.merkle = merkle
+		self.merkle_root = None
 		
 	def _hash_block(self):
+		if self.merkle:
+			return hashlib.sha256(bytearray(str(self.pre_hash) + str(self.timestamp) + self.merkle_root, "utf-8")).hexdigest()
 		return hashlib.sha256(bytearray(str(self.pre_hash) + str(self.timestamp) + self.messages[-1].hash, "utf-8")).hexdigest()
 
+	def proof_for(self, message_id):
+		""" Inclusion proof of the message with the given id (or message hash):
+			[(sibling hash, 'L' or 'R'), ...] from the leaf up to merkle_root.
+		"""
+		if not self.merkle:
+			raise InvalidBlock("Block is not in merkle mode: " + str(self))
+		for index, message in enumerate(self.messages):
+			if message.id == message_id or message.hash == message_id:
+				break
+		else:
+			raise KeyError(message_id)
+		proof = []
+		for level in _merkle_levels([m.hash for m in self.messages])[:-1]:
+			sibling = index ^ 1
+			if sibling < len(level):
+				proof.append((level[sibling].hex(), 'L' if sibling < index else 'R'))
+			index //= 2
+		return proof
+
 	def add_message(self, message):
 		if len(self.messages) > 0:
 			message.link(self.messages[-1])
@@ -73,12 +185,27 @@ class Block(object):
 		message.validate()
 		self.messages.append(message)
 
+	def add_messages(self, messages):
+		""" Link and seal a batch of freshly built messages in one pass.
+			Their payload hashes were just computed, so they are not validated
+			again here; Chain.validate() still covers them.
+		"""
+		last = self.messages[-1] if self.messages else None
+		for message in messages:
+			if last is not None:
+				message.link(last)
+			message.seal()
+			last = message
+		self.messages.extend(messages)
+
 	def  link(self, block):
 		self.pre_hash = block.hash
 
 	def seal(self):
 		#self.timestamp = time.time()
 		self.timestamp  = time.asctime(time.localtime(time.time()))
+		if self.merkle:
+			self.merkle_root = merkle_root([m.hash for m in self.messages])
 		self.hash = self._hash_block()
 
 	def validate(self):
@@ -97,6 +224,10 @@ class Block(object):
 				raise InvalidBlock("Invalid block: Message #{} failed validation: {}. In block: {}".format(
 					i, str(ex), str(self))
 				)
+		if self.merkle and self.merkle_root != merkle_root([m.hash for m in self.messages]):
+			raise InvalidBlock("Invalid merkle root in block: " + str(self))
+		if self.hash != self._hash_block():
+			raise InvalidBlock("Invalid block hash in block: " + str(self))
 
 	def __repr__(self):
 		return 'Block<hash: {}, pre_hash: {}, messages: {}, time: {}>'.format(
@@ -105,28 +236,227 @@ class Block(object):
 
 class Chain(object):
 	"""docstring for Chain"""
-	def __init__(self):
+	def __init__(self, store = None):
+		""" store: a chain_store.ChainStore to persist the blocks in, the
+			chain is kept in a plain list when it is None.
+		"""
 		super(Chain, self).__init__()
-		self.chain = []
+		self.chain = store if store is not None else []
+		#lookup index, key --> [(block index, message index), ...]
+		self.content_index = {}
+		self.id_index = {}
+		self.sender_index = {}
+		self.block_index = {}	#block hash --> block index
+		self.indexed = 0	#blocks of a reopened store are indexed on first lookup
+		self.store = store
+		#(height, tip hash): blocks below height are trusted
+		self.checkpoint = self._load_checkpoint('checkpoint')
+		#progress of an unfinished full audit
+		self.audit_checkpoint = self._load_checkpoint('audit')
+		#ingest(): a block is sealed when one of the limits is reached
+		self.batch_messages = 1000
+		self.batch_bytes = 4 * 1024 * 1024
+		self.batch_seconds = 1.0
+		self.batch_merkle = False
+		self.pending = []
+		self.pending_bytes = 0
+		self.pending_since = None
 
-	def add_block(self, block):
+	def add_block(self, block, validate = True):
+		""" validate: False skips Block.validate() for blocks whose messages
+			were hashed and sealed just before (see ingest()).
+		"""
 		#add valid block
 		if len(self.chain) > 0:
 			#print('test')
 			block.pre_hash = self.chain[-1].hash
 		block.seal()
-		block.validate()
+		if validate:
+			block.validate()
 		self.chain.append(block)
+		if self.indexed == len(self.chain) - 1:
+			self._index_block(len(self.chain) - 1, block)
+
+	def _message_bytes(self, message):
+		if isinstance(message.content, (str, bytes)):
+			return len(message.content)
+		return sum(len(x) for x in message.content if isinstance(x, (str, bytes)))
+
+	def ingest(self, message):
+		""" Queue an Email_Content for the next block.
+
+			The pending messages are sealed into one block once batch_messages,
+			batch_bytes or batch_seconds (checked on each call) is reached.
+			Returns the sealed block, or None while the batch is still open.
+		"""
+		if not self.pending:
+			self.pending_since = time.time()
+		self.pending.append(message)
+		self.pending_bytes += self._message_bytes(message)
+		if (len(self.pending) >= self.batch_messages or self.pending_bytes >= self.batch_bytes
+				or time.time() - self.pending_since >= self.batch_seconds):
+			return self.flush_ingest()
+		return None
+
+	def ingest_many(self, messages):
+		""" ingest() every message, returns the blocks sealed on the way. """
+		blocks = []
+		for message in messages:
+			block = self.ingest(message)
+			if block is not None:
+				blocks.append(block)
+		return blocks
+
+	def flush_ingest(self):
+		""" Seal the pending messages into a block now. """
+		if not self.pending:
+			return None
+		block = Block(self.batch_merkle)
+		block.add_messages(self.pending)
+		self.add_block(block, validate = False)
+		self.pending = []
+		self.pending_bytes = 0
+		self.pending_since = None
+		return block
+
+	def _index_key(self, value):
+		""" Lists (the decoded email header fields) are not hashable, use a tuple. """
+		if isinstance(value, list):
+			return tuple(self._index_key(x) for x in value)
+		return value
+
+	def _message_sender(self, message):
+		""" The sender is the second field of a decoded email, raw text has none. """
+		if isinstance(message.content, list) and len(message.content) > 1:
+			return message.content[1]
+		return None
+
+	def _index_block(self, block_index, block):
+		self.indexed = block_index + 1
+		self.block_index[block.hash] = block_index
+		for message_index, message in enumerate(block.messages):
+			position = (block_index, message_index)
+			self.content_index.setdefault(message.content_hash, []).append(position)
+			self.id_index.setdefault(self._index_key(message.id), []).append(position)
+			sender = self._message_sender(message)
+			if sender is not None:
+				self.sender_index.setdefault(sender, []).append(position)
+
+	def reindex(self):
+		""" Rebuild every lookup index from self.chain. """
+		self.content_index = {}
+		self.id_index = {}
+		self.sender_index = {}
+		self.block_index = {}
+		self.indexed = 0
+		self._catch_up()
+
+	def _catch_up(self):
+		for i in range(self.indexed, len(self.chain)):
+			self._index_block(i, self.chain[i])
+
+	def has_content(self, content_hash):
+		self._catch_up()
+		return content_hash in self.content_index
+
+	def find_content(self, content_hash):
+		""" Return the [(block index, message index), ...] holding the content hash. """
+		self._catch_up()
+		return list(self.content_index.get(content_hash, []))
+
+	def find_id(self, message_id):
+		self._catch_up()
+		return list(self.id_index.get(self._index_key(message_id), []))
+
+	def find_sender(self, sender):
+		self._catch_up()
+		return list(self.sender_index.get(sender, []))
+
+	def find_block(self, block_hash):
+		""" Return the index of the block with the given hash, or None. """
+		self._catch_up()
+		return self.block_index.get(block_hash)
+
+	def get_message(self, position):
+		block_index, message_index = position
+		return self.chain[block_index].messages[message_index]
 
 	def validate(self):
 		""" Validates each block, in order.
 			An invalid block invalidates the chain.
 		"""
-		for i, block in enumerate(self.simple_chain):
+		self._validate_range(0, len(self.chain))
+		self._set_checkpoint('checkpoint', len(self.chain))
+		return True
+
+	def _validate_range(self, start, end, on_block = None):
+		""" Validates blocks [start, end) and their links to the previous block. """
+		pre_hash = self.chain[start - 1].hash if start > 0 else None
+		for i in range(start, end):
+			block = self.chain[i]
 			try:
 				block.validate()
+				if i > 0 and block.pre_hash != pre_hash:
+					raise InvalidBlock("Invalid block: block has invalid block link: {}".format(str(block)))
 			except InvalidBlock as exc:
 				raise InvalidBlockchain("Invalid blockchain at block number {} caused by: {}".format(i, str(exc)))
+			pre_hash = block.hash
+			if on_block is not None:
+				on_block(i)
+
+	def _load_checkpoint(self, name):
+		if self.store is None:
+			return None
+		return self.store.load_checkpoint(name)
+
+	def _set_checkpoint(self, name, height):
+		checkpoint = (height, self.chain[height - 1].hash) if height > 0 else None
+		if name == 'checkpoint':
+			self.checkpoint = checkpoint
+		else:
+			self.audit_checkpoint = checkpoint
+		if self.store is not None:
+			self.store.save_checkpoint(name, checkpoint)
+
+	def _check_checkpoint(self, checkpoint):
+		""" The block at the checkpoint must still be the one that was verified. """
+		height, tip_hash = checkpoint
+		if height > len(self.chain) or self.chain[height - 1].hash != tip_hash:
+			raise InvalidBlockchain("Invalid blockchain: block number {} does not match checkpoint {}".format(
+				height - 1, tip_hash)
+			)
+
+	def validate_incremental(self):
+		""" Validates only the blocks appended since the last checkpoint,
+			then moves the checkpoint to the tip.
+			Without a checkpoint the whole chain is validated.
+		"""
+		start = 0
+		if self.checkpoint is not None:
+			self._check_checkpoint(self.checkpoint)
+			start = self.checkpoint[0]
+		self._validate_range(start, len(self.chain))
+		self._set_checkpoint('checkpoint', len(self.chain))
+		return True
+
+	def validate_full(self, resume = True, audit_every = 1000):
+		""" Validates the whole chain from the genesis block.
+
+			Progress is recorded every audit_every blocks, an audit that was
+			interrupted continues from there when resume is True.
+		"""
+		start = 0
+		if resume and self.audit_checkpoint is not None:
+			self._check_checkpoint(self.audit_checkpoint)
+			start = self.audit_checkpoint[0]
+
+		def on_block(i):
+			if (i + 1) % audit_every == 0:
+				self._set_checkpoint('audit', i + 1)
+
+		self._validate_range(start, len(self.chain), on_block)
+		self._set_checkpoint('audit', 0)
+		self._set_checkpoint('checkpoint', len(self.chain))
 		return True
 
 	def __repr__(self):
@@ -0,0 +1,349 @@
+'''-*- coding: utf-8 -*-'''
+
+import os
+import json
+import mmap
+import zlib
+import base64
+import struct
+import bisect
+from array import array
+
+import blockchain
+
+"""
+Append-only segment store for the mail chain.
+
+	<dir>/00000000.seg	records: [length u32][crc32 u32][json block]
+	<dir>/00000000.idx	one u64 offset per record of the segment
+
+Segments are named by the height of their first block. Only the last
+segment is ever written; sealed segments are read through mmap.
+"""
+
+HEADER = struct.Struct('<II')	#record length, crc32 of the record
+OFFSET = struct.Struct('<Q')	#record offset in the segment
+
+
+def _encode_value(value):
+	""" Attachments are bytes, json can not hold them. """
+	if isinstance(value, (bytes, bytearray, memoryview)):
+		return {'__bytes__': base64.b64encode(bytes(value)).decode('ascii')}
+	if isinstance(value, list):
+		return [_encode_value(x) for x in value]
+	return value
+
+def _decode_value(value):
+	if isinstance(value, dict) and '__bytes__' in value:
+		return base64.b64decode(value['__bytes__'])
+	if isinstance(value, list):
+		return [_decode_value(x) for x in value]
+	return value
+
+def _put_blobs(value, blobs):
+	""" Move attachments of decoded content into the blob store. """
+	if isinstance(value, (bytes, bytearray, memoryview)):
+		return {'__blob__': blobs.put(value)}
+	if isinstance(value, list):
+		return [_put_blobs(x, blobs) for x in value]
+	return value
+
+def _resolve_blobs(value, blobs):
+	if isinstance(value, dict) and '__blob__' in value:
+		return _resolve_blobs(blobs.get(value['__blob__']), blobs)
+	if isinstance(value, list):
+		return [_resolve_blobs(x, blobs) for x in value]
+	return _decode_value(value)
+
+def message_to_record(message, blobs = None):
+	""" blobs: a blob_store.BlobStore, the record then only references the
+		content by its content hash.
+	"""
+	if blobs is None:
+		content = _encode_value(message.content)
+	elif isinstance(message.content, list):
+		content = {'__blob__': blobs.put(_put_blobs(message.content, blobs), message.content_hash)}
+	else:
+		content = {'__blob__': blobs.put(message.content, message.content_hash)}
+	return {
+		'content': content,
+		'timestamp': message.timestamp,
+		'hash': message.hash,
+		'pre_hash': message.pre_hash,
+		'content_hash': message.content_hash,
+		'payload_hash': message.payload_hash,
+	}
+
+def message_from_record(record, blobs = None):
+	""" Rebuild a sealed Email_Content without hashing it again. """
+	message = blockchain.Email_Content.__new__(blockchain.Email_Content)
+	if blobs is None:
+		message.content = _decode_value(record['content'])
+	else:
+		message.content = _resolve_blobs(record['content'], blobs)
+	message.id = message.content[:-1]
+	message.timestamp = record['timestamp']
+	message.hash = record['hash']
+	message.pre_hash = record['pre_hash']
+	message.content_hash = record['content_hash']
+	message.payload_hash = record['payload_hash']
+	message.size = message.get_size
+	return message
+
+def block_to_record(block, blobs = None):
+	return {
+		'hash': block.hash,
+		'pre_hash': block.pre_hash,
+		'timestamp': block.timestamp,
+		'merkle_root': block.merkle_root,
+		'messages': [message_to_record(m, blobs) for m in block.messages],
+	}
+
+def block_from_record(record, blobs = None):
+	block = blockchain.Block.__new__(blockchain.Block)
+	block.messages = [message_from_record(m, blobs) for m in record['messages']]
+	block.timestamp = record['timestamp']
+	block.hash = record['hash']
+	block.pre_hash = record['pre_hash']
+	block.merkle_root = record.get('merkle_root')
+	block.merkle = block.merkle_root is not None
+	return block
+
+
+class ChainStore(object):
+	"""Append-only, crash safe storage of sealed blocks.
+
+		The store behaves like the list in Chain.chain (len, index, iterate,
+		append), so it can be handed to blockchain.Chain(store). Blocks are
+		decoded lazily from the segment files, opening the store only reads
+		the offset indexes and checks the tail of the last segment.
+
+		sync_every: fsync the segment and its index after this many appends,
+		0 leaves syncing to flush()/close().
+		blobs: a blob_store.BlobStore, message contents are then stored once
+		per content hash and the segments only reference them.
+	"""
+	def __init__(self, directory, segment_size = 64 * 1024 * 1024, sync_every = 64, blobs = None):
+		super(ChainStore, self).__init__()
+		self.directory = directory
+		self.blobs = blobs
+		self.segment_size = segment_size
+		self.sync_every = sync_every
+		self.bases = []		#height of the first block of each segment
+		self.offsets = []	#array('Q') of record offsets per segment
+		self.maps = {}		#segment number --> mmap of sealed segments
+		self.pending = 0	#appends since the last fsync
+		self.tip = None		#last block, Chain.add_block reads it every time
+		self.seg_file = None
+		self.idx_file = None
+		self.seg_size = 0
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._open()
+
+	def _path(self, base, ext):
+		return os.path.join(self.directory, '%08d.%s' % (base, ext))
+
+	def _open(self):
+		bases = sorted(int(f[:-4]) for f in os.listdir(self.directory) if f.endswith('.seg'))
+		for base in bases:
+			self.bases.append(base)
+			self.offsets.append(self._read_index(base))
+		if not self.bases:
+			self.bases.append(0)
+			self.offsets.append(array('Q'))
+		self._recover()
+		base = self.bases[-1]
+		self.seg_file = open(self._path(base, 'seg'), 'a+b')
+		self.idx_file = open(self._path(base, 'idx'), 'ab')
+		self.seg_size = self.seg_file.tell()
+
+	def _read_index(self, base):
+		offsets = array('Q')
+		path = self._path(base, 'idx')
+		if os.path.exists(path):
+			with open(path, 'rb') as f:
+				data = f.read()
+			#a torn write can leave half an entry
+			offsets.frombytes(data[:len(data) - len(data) % OFFSET.size])
+		return offsets
+
+	def _read_record(self, data, offset):
+		""" Return the record bytes at offset, None if it is torn or corrupt. """
+		if offset + HEADER.size > len(data):
+			return None
+		length, crc = HEADER.unpack_from(data, offset)
+		start = offset + HEADER.size
+		if start + length > len(data):
+			return None
+		record = data[start:start + length]
+		if zlib.crc32(record) & 0xffffffff != crc:
+			return None
+		return record
+
+	def _recover(self):
+		""" Check the tail of the last segment after a crash.
+
+			Index entries pointing at torn records are dropped, valid records
+			missing from the index are added, and garbage after the last valid
+			record is truncated.
+		"""
+		base = self.bases[-1]
+		seg_path = self._path(base, 'seg')
+		if not os.path.exists(seg_path):
+			open(seg_path, 'wb').close()
+		with open(seg_path, 'rb') as f:
+			data = f.read()
+		offsets = self.offsets[-1]
+		valid = array('Q')
+		end = 0
+		for offset in offsets:
+			record = self._read_record(data, offset)
+			if record is None or offset != end:
+				break
+			valid.append(offset)
+			end = offset + HEADER.size + len(record)
+		while True:
+			record = self._read_record(data, end)
+			if record is None:
+				break
+			valid.append(end)
+			end += HEADER.size + len(record)
+		if end != len(data):
+			with open(seg_path, 'r+b') as f:
+				f.truncate(end)
+				os.fsync(f.fileno())
+		if valid != offsets:
+			with open(self._path(base, 'idx'), 'wb') as f:
+				f.write(valid.tobytes())
+				os.fsync(f.fileno())
+		self.offsets[-1] = valid
+
+	def __len__(self):
+		return self.bases[-1] + len(self.offsets[-1])
+
+	def _locate(self, height):
+		segment = bisect.bisect_right(self.bases, height) - 1
+		return segment, self.offsets[segment][height - self.bases[segment]]
+
+	def _record_at(self, segment, offset):
+		if segment == len(self.bases) - 1:
+			#the active segment still grows, read it with pread
+			self.seg_file.flush()
+			fd = self.seg_file.fileno()
+			length, crc = HEADER.unpack(os.pread(fd, HEADER.size, offset))
+			return os.pread(fd, length, offset + HEADER.size)
+		data = self.maps.get(segment)
+		if data is None:
+			with open(self._path(self.bases[segment], 'seg'), 'rb') as f:
+				data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+			self.maps[segment] = data
+		length, crc = HEADER.unpack_from(data, offset)
+		start = offset + HEADER.size
+		return data[start:start + length]
+
+	def __getitem__(self, height):
+		if isinstance(height, slice):
+			return [self[i] for i in range(*height.indices(len(self)))]
+		if height < 0:
+			height += len(self)
+		if height < 0 or height >= len(self):
+			raise IndexError('block height out of range')
+		if height == len(self) - 1 and self.tip is not None:
+			return self.tip
+		segment, offset = self._locate(height)
+		block = block_from_record(json.loads(self._record_at(segment, offset).decode('utf-8')), self.blobs)
+		if height == len(self) - 1:
+			self.tip = block
+		return block
+
+	def raw_record(self, height):
+		""" The encoded block at height, without decoding it. """
+		if height < 0:
+			height += len(self)
+		segment, offset = self._locate(height)
+		return bytes(self._record_at(segment, offset))
+
+	def __iter__(self):
+		for height in range(len(self)):
+			yield self[height]
+
+	def append(self, block):
+		""" Write a sealed block at the end of the active segment. """
+		record = json.dumps(block_to_record(block, self.blobs), separators = (',', ':')).encode('utf-8')
+		if self.seg_size > 0 and self.seg_size + HEADER.size + len(record) > self.segment_size:
+			self._roll()
+		offset = self.seg_size
+		self.seg_file.write(HEADER.pack(len(record), zlib.crc32(record) & 0xffffffff))
+		self.seg_file.write(record)
+		self.idx_file.write(OFFSET.pack(offset))
+		self.seg_size += HEADER.size + len(record)
+		self.offsets[-1].append(offset)
+		self.tip = block
+		self.pending += 1
+		if self.sync_every and self.pending >= self.sync_every:
+			self.flush()
+
+	def _roll(self):
+		""" Seal the active segment and start a new one. """
+		self.flush()
+		self.seg_file.close()
+		self.idx_file.close()
+		base = len(self)
+		self.bases.append(base)
+		self.offsets.append(array('Q'))
+		self.seg_file = open(self._path(base, 'seg'), 'a+b')
+		self.idx_file = open(self._path(base, 'idx'), 'ab')
+		self.seg_size = 0
+
+	def save_checkpoint(self, name, checkpoint):
+		""" Store a (height, block hash) checkpoint, None removes it. """
+		path = os.path.join(self.directory, name + '.json')
+		if checkpoint is None:
+			if os.path.exists(path):
+				os.remove(path)
+			return
+		#the blocks below the checkpoint have to be on disk first
+		self.flush()
+		temp = path + '.tmp'
+		with open(temp, 'w') as f:
+			json.dump({'height': checkpoint[0], 'hash': checkpoint[1]}, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(temp, path)
+
+	def load_checkpoint(self, name):
+		path = os.path.join(self.directory, name + '.json')
+		if not os.path.exists(path):
+			return None
+		with open(path) as f:
+			record = json.load(f)
+		return record['height'], record['hash']
+
+	def flush(self):
+		""" fsync the pending appends, the segment before its index. """
+		if self.seg_file is None:
+			return
+		#referenced blobs have to be on disk before the records
+		if self.blobs is not None:
+			self.blobs.flush()
+		self.seg_file.flush()
+		os.fsync(self.seg_file.fileno())
+		self.idx_file.flush()
+		os.fsync(self.idx_file.fileno())
+		self.pending = 0
+
+	def close(self):
+		self.flush()
+		self.seg_file.close()
+		self.idx_file.close()
+		self.seg_file = None
+		self.idx_file = None
+		for data in self.maps.values():
+			data.close()
+		self.maps = {}
+
+	def __repr__(self):
+		return 'ChainStore<dir: {}, blocks: {}, segments: {}>'.format(
+			self.directory, len(self), len(self.bases)
+		)
@@ -0,0 +1,121 @@
+'''-*- coding: utf-8 -*-'''
+
+import time
+import functools
+
+import blockchain
+import chain_store
+
+"""
+Compact in-memory form of sealed Email_Content and Block objects.
+
+Hashes are kept as raw 32-byte digests, timestamps as integer epoch seconds
+and the content can be offloaded to any mapping keyed by the content hash.
+The asctime strings of the originals have second resolution, so converting
+back gives objects with the very same hashes.
+"""
+
+
+def _digest(value):
+	return bytes.fromhex(value) if value is not None else None
+
+def _hexdigest(value):
+	return value.hex() if value is not None else None
+
+@functools.lru_cache(maxsize = 4096)
+def _epoch(timestamp):
+	""" Mails sealed in the same second share the timestamp, strptime is slow. """
+	if timestamp is None:
+		return None
+	return int(time.mktime(time.strptime(timestamp)))
+
+def _asctime(epoch):
+	if epoch is None:
+		return None
+	return time.asctime(time.localtime(epoch))
+
+def _size(content):
+	if isinstance(content, (bytes, bytearray, memoryview)):
+		return memoryview(content).nbytes
+	if isinstance(content, str):
+		return len(content.encode('utf-8'))
+	return sum(_size(x) for x in content)
+
+
+class CompactMessage(object):
+	"""Sealed message with slots, raw digests and an epoch timestamp."""
+	__slots__ = ('content', 'timestamp', 'hash', 'pre_hash', 'content_hash', 'payload_hash', 'size')
+
+	def __init__(self, content, timestamp, hash, pre_hash, content_hash, payload_hash, size):
+		self.content = content	#None when offloaded
+		self.timestamp = timestamp
+		self.hash = hash
+		self.pre_hash = pre_hash
+		self.content_hash = content_hash
+		self.payload_hash = payload_hash
+		self.size = size	#content length in bytes
+
+	@classmethod
+	def from_message(cls, message, offload = None):
+		""" offload: mapping to move the content to, keyed by the hex content hash. """
+		content = message.content
+		if offload is not None:
+			offload[message.content_hash] = content
+			content = None
+		return cls(content, _epoch(message.timestamp), _digest(message.hash), _digest(message.pre_hash),
+			_digest(message.content_hash), _digest(message.payload_hash), _size(message.content))
+
+	def get_content(self, offload = None):
+		if self.content is not None:
+			return self.content
+		return offload[self.content_hash.hex()]
+
+	def to_message(self, offload = None):
+		return chain_store.message_from_record({
+			'content': self.get_content(offload),
+			'timestamp': _asctime(self.timestamp),
+			'hash': _hexdigest(self.hash),
+			'pre_hash': _hexdigest(self.pre_hash),
+			'content_hash': _hexdigest(self.content_hash),
+			'payload_hash': _hexdigest(self.payload_hash),
+		})
+
+	def __repr__(self):
+		return 'CompactMessage<hash: {}, pre_hash: {}, size: {}>'.format(
+			_hexdigest(self.hash), _hexdigest(self.pre_hash), self.size
+		)
+
+
+class CompactBlock(object):
+	"""Sealed block holding a tuple of CompactMessage."""
+	__slots__ = ('messages', 'timestamp', 'hash', 'pre_hash', 'merkle_root')
+
+	def __init__(self, messages, timestamp, hash, pre_hash, merkle_root):
+		self.messages = messages
+		self.timestamp = timestamp
+		self.hash = hash
+		self.pre_hash = pre_hash
+		self.merkle_root = merkle_root
+
+	@classmethod
+	def from_block(cls, block, offload = None):
+		return cls(tuple(CompactMessage.from_message(m, offload) for m in block.messages),
+			_epoch(block.timestamp), _digest(block.hash), _digest(block.pre_hash), _digest(block.merkle_root))
+
+	def to_block(self, offload = None):
+		block = blockchain.Block(self.merkle_root is not None)
+		block.messages = [m.to_message(offload) for m in self.messages]
+		block.timestamp = _asctime(self.timestamp)
+		block.hash = _hexdigest(self.hash)
+		block.pre_hash = _hexdigest(self.pre_hash)
+		block.merkle_root = _hexdigest(self.merkle_root)
+		return block
+
+	def __repr__(self):
+		return 'CompactBlock<hash: {}, pre_hash: {}, messages: {}, time: {}>'.format(
+			_hexdigest(self.hash), _hexdigest(self.pre_hash), len(self.messages), _asctime(self.timestamp)
+		)
+
+def compact_chain(chain, offload = None):
+	""" List of CompactBlock for every block of the chain. """
+	return [CompactBlock.from_block(block, offload) for block in chain.chain]
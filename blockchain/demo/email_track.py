@@ -3,7 +3,7 @@
 
 from email import encoders
 from email.header import Header, decode_header
-from email.parser import Parser
+from email.parser import BytesFeedParser
 from email.mime.text import MIMEText
 from email.utils import parseaddr, formataddr
 #smtp, pop3協議
@@ -13,6 +13,12 @@ import poplib
 import hashlib
 import datetime
 import time
+#bulk fetching
+import os
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 class send_email(object):
 	"""docstring for send_email"""
@@ -46,6 +52,136 @@ class send_email(object):
 		print('------success------')
 		server.quit()
 
+class bulk_send_email(object):
+	"""Send many messages over a pool of authenticated SMTP sessions.
+
+		Every session is connected, STARTTLS'ed and logged in once and then
+		reused for all the messages its worker sends; a dropped session is
+		reconnected and the message retried once.
+	"""
+	def __init__(self, from_addr, password, smtp_server, port = 587, pool_size = 4, starttls = True, timeout = 30):
+		super(bulk_send_email, self).__init__()
+		self.from_addr = from_addr
+		self.password = password
+		self.smtp_server = smtp_server
+		self.port = port
+		self.pool_size = pool_size
+		self.starttls = starttls
+		self.timeout = timeout
+		self.sessions = queue.Queue()	#idle authenticated sessions
+
+	def _format_addr(self, s):
+	    name, addr = parseaddr(s)
+	    return formataddr((Header(name, 'utf-8').encode(), addr))
+
+	def create_message(self, to_addr, message, subject = 'Email track testing'):
+		"""Type --> Text"""
+		msg = MIMEText(message, 'plain', 'utf-8')
+		msg['From'] = self._format_addr('Python <%s>' % self.from_addr)
+		msg['To'] = self._format_addr('管理員 <%s>' % to_addr)
+		msg['Subject'] = Header(subject, 'utf-8').encode()
+		return msg
+
+	def _connect(self):
+		server = smtplib.SMTP(self.smtp_server, self.port, timeout = self.timeout)
+		try:
+			if self.starttls:
+				server.starttls()
+			if self.password is not None:
+				server.login(self.from_addr, self.password)
+		except OSError:
+			self._discard(server)
+			raise
+		return server
+
+	def _session(self):
+		try:
+			return self.sessions.get_nowait()
+		except queue.Empty:
+			return self._connect()
+
+	def _discard(self, server):
+		try:
+			server.close()
+		except OSError:
+			pass
+
+	def _send_all(self, jobs, stats):
+		server = None
+		try:
+			while True:
+				try:
+					to_addr, msg = jobs.get_nowait()
+				except queue.Empty:
+					break
+				for attempt in range(2):
+					try:
+						if server is None:
+							server = self._session()
+						server.sendmail(self.from_addr, [to_addr], msg.as_string())
+						stats.sent()
+						break
+					except smtplib.SMTPServerDisconnected:
+						pass
+					except smtplib.SMTPException:
+						#refused by the server (or the login), the session itself is fine
+						stats.failed(to_addr)
+						break
+					except OSError:
+						pass
+					#the session went away or never came up, reconnect and retry once
+					if server is not None:
+						self._discard(server)
+						server = None
+					if attempt == 1:
+						stats.failed(to_addr)
+		finally:
+			#only live sessions go back to the pool
+			if server is not None:
+				self.sessions.put(server)
+
+	def send(self, messages):
+		""" Send [(to_addr, MIMEText), ...], returns the throughput report:
+			{'sent', 'failed', 'seconds', 'messages_per_s'}
+		"""
+		jobs = queue.Queue()
+		for job in messages:
+			jobs.put(job)
+		stats = _send_stats()
+		start = time.perf_counter()
+		with ThreadPoolExecutor(max_workers = self.pool_size) as pool:
+			for future in [pool.submit(self._send_all, jobs, stats) for i in range(self.pool_size)]:
+				future.result()
+		seconds = time.perf_counter() - start
+		return {
+			'sent': stats.count,
+			'failed': stats.failures,
+			'seconds': seconds,
+			'messages_per_s': stats.count / seconds if seconds else 0.0,
+		}
+
+	def close(self):
+		while not self.sessions.empty():
+			server = self.sessions.get_nowait()
+			try:
+				server.quit()
+			except (smtplib.SMTPException, OSError):
+				server.close()
+
+class _send_stats(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.count = 0
+		self.failures = []	#recipients that could not be sent to
+
+	def sent(self):
+		with self.lock:
+			self.count += 1
+
+	def failed(self, to_addr):
+		with self.lock:
+			self.failures.append(to_addr)
+
 class fetch_email(object):
 	"""docstring for fetch_email"""
 	def __init__(self, email, password, pop3_server):
@@ -57,10 +193,13 @@ class fetch_email(object):
 		self.block_message = []
 
 	def decode_str(self, s):
-	    value, charset = decode_header(s)[0]
-	    if charset:
-	        value = value.decode(charset)
-	    return value
+	    #raw 8-bit headers come back with charset unknown-8bit, decode_text falls back to utf-8 for them
+	    parts = []
+	    for value, charset in decode_header(s):
+	        if isinstance(value, bytes):
+	            value = self.decode_text(value, charset or 'utf-8')
+	        parts.append(value)
+	    return ''.join(parts)
 
 	def guess_charset(self, m):
 	    charset = m.get_charset()
@@ -101,39 +240,66 @@ class fetch_email(object):
 	        else:
 	            print('%sAttachment: %s' % ('  ' * indent, content_type))
 
-	def content(self, temp_msg, temp_content):
+	def decode_text(self, data, charset):
+		""" Undecodable bytes and unknown charsets must not lose the mail. """
+		try:
+			return data.decode(charset, 'replace')
+		except LookupError:
+			return data.decode('utf-8', 'replace')
+
+	def parse_lines(self, lines):
+		""" Parse the raw lines of poplib.retr() one by one, as bytes.
+
+			Nothing is joined or decoded up front, so mail that is not UTF-8
+			parses too; parts are only decoded by content().
+		"""
+		parser = BytesFeedParser()
+		for line in lines:
+			parser.feed(line)
+			parser.feed(b'\r\n')
+		return parser.close()
+
+	def content(self, temp_msg, temp_content, show = True):
 	    for par in temp_msg.walk():
 	        if not par.is_multipart(): # 这里要判断是否是multipart，是的话，里面的数据是一个message 列表
 	            name = par.get_param('name')
 	            if name:    #有附件
-	                file_name = decode_str(name)
-	                print('File name: ', file_name)
+	                if show:
+	                    file_name = self.decode_str(name)
+	                    print('File name: ', file_name)
 	                data = par.get_payload(decode = True)   #　解码出附件数据，然后存储到文件中
 	                temp_content.append(data)
 	            else:
 	                temp = par.get_payload(decode = True)
 	                charset = self.guess_charset(par)
 	                if charset:
-	                    temp = temp.decode(charset)
+	                    temp = self.decode_text(temp, charset)
 	                temp_content.append(temp)
 	            temp_content.append('\n\t')	#split the data
 
+	def make_block_message(self, msg, show = False):
+		""" [subject, from, date, message id, content parts] of a parsed email.
+
+			show prints the attachment names, bulk fetching leaves it off.
+		"""
+		subject = self.decode_str(msg.get('subject', ''))
+		temp_content = []	#存儲郵件內容
+		self.content(msg, temp_content, show)
+		return [subject, parseaddr(msg.get('from'))[1], msg.get('date'), parseaddr(msg.get('message-id'))[1], temp_content]
+
 	def decode_email(self):
 		if not self.msg:
 			return 'No msg'
 		#self.print_info(self.msg)
-		subject = self.msg.get('subject')
-		subject = self.decode_str(subject)
-		temp_content = []	#存儲郵件內容
-		self.content(self.msg, temp_content)
+		self.block_message = self.make_block_message(self.msg, show = True)
+		subject, sender, date, message_id, temp_content = self.block_message
 		print('\n%s' % ('-'*60))
 		print('----Subject: ', subject)
-		print('----From: ', parseaddr(self.msg.get('from'))[1])
-		print('----Date: ', self.msg.get('date'))
-		print('----MessagesID: ', parseaddr(self.msg.get('message-id'))[1])
+		print('----From: ', sender)
+		print('----Date: ', date)
+		print('----MessagesID: ', message_id)
 		print('----Content: ', temp_content)
 		print('%s' % ('-'*60))
-		self.block_message = [subject, parseaddr(self.msg.get('from'))[1], self.msg.get('date'), parseaddr(self.msg.get('message-id'))[1], temp_content]
 
 	def connect(self):
 		#server = poplib.POP3_SSL('pop.googlemail.com', '995')	#連接到pop3_server
@@ -151,9 +317,114 @@ class fetch_email(object):
 		#print(mail) --> [b'1 82923', b'2 2184', ...]
 		index = len(mails)
 		resp, lines, octets = server.retr(index)	#取最近的一封郵件
-		msg_content = b'\r\n'.join(lines).decode('utf-8')	#lines存儲郵件的原始文本的每一行，獲得整個原始文本
 
-		#解析郵件
-		self.msg = Parser().parsestr(msg_content)
+		#解析郵件, lines存儲郵件的原始文本的每一行
+		self.msg = self.parse_lines(lines)
+
+class bulk_fetch_email(object):
+	"""Fetch the new messages of many POP3 mailboxes concurrently.
+
+		mailboxes: [(email, password, pop3_server), ...]
+		A mailbox is read over one authenticated session for all of its
+		messages (POP3 locks the maildrop per session, RFC 1939), the
+		sessions of different mailboxes run on a pool of max_workers threads.
+		The UIDLs passed to mark_fetched() are kept in uidl_file, so the next
+		run skips mail that is already in the chain.
+	"""
+	def __init__(self, mailboxes, max_workers = 8, uidl_file = None, port = 995, use_ssl = True, timeout = 30):
+		super(bulk_fetch_email, self).__init__()
+		self.mailboxes = mailboxes
+		self.max_workers = max_workers
+		self.uidl_file = uidl_file
+		self.port = port
+		self.use_ssl = use_ssl
+		self.timeout = timeout
+		self.seen = {}		#email --> set of fetched UIDLs
+		self.errors = {}	#email --> exception ending that mailbox, (email, uid) --> exception of one message
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		if uidl_file and os.path.exists(uidl_file):
+			with open(uidl_file) as f:
+				self.seen = dict((k, set(v)) for k, v in json.load(f).items())
+
+	def _login(self, email, password, pop3_server):
+		if self.use_ssl:
+			server = poplib.POP3_SSL(pop3_server, self.port, timeout = self.timeout)
+		else:
+			server = poplib.POP3(pop3_server, self.port, timeout = self.timeout)
+		server.user(email)
+		server.pass_(password)
+		return server
+
+	def _fetch_mailbox(self, mailbox, results, only_new):
+		email, password, pop3_server = mailbox
+		decoder = fetch_email(email, password, pop3_server)
+		try:
+			server = self._login(email, password, pop3_server)
+			try:
+				with self.lock:
+					seen = set(self.seen.get(email, ()))
+				resp, listings, octets = server.uidl()	#[b'1 uid', b'2 uid', ...]
+				for listing in listings:
+					if self.stopped.is_set():
+						break
+					#RFC 1939 UIDs are printable ASCII, surrogateescape keeps a broken one unique
+					number, uid = listing.decode('ascii', 'surrogateescape').split(None, 1)
+					if only_new and uid in seen:
+						continue
+					resp, lines, octets = server.retr(int(number))
+					try:
+						block_message = decoder.make_block_message(decoder.parse_lines(lines))
+					except Exception as exc:
+						#one broken mail must not cost the rest of the mailbox
+						self.errors[(email, uid)] = exc
+						continue
+					results.put((email, uid, block_message))
+			finally:
+				server.quit()
+		except Exception as exc:
+			#nobody reads the worker's future, whatever ended the mailbox has to be recorded here
+			self.errors[email] = exc
+		finally:
+			results.put(None)	#this mailbox is done
+
+	def fetch(self, only_new = True):
+		""" Yield (email, uid, block_message) as soon as they are parsed.
+
+			Nothing counts as fetched yet: pass the (email, uid) of messages
+			to mark_fetched() once they are sealed in the chain.
+		"""
+		self.errors = {}
+		self.stopped.clear()
+		results = queue.Queue(maxsize = self.max_workers * 16)
+		with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+			for mailbox in self.mailboxes:
+				pool.submit(self._fetch_mailbox, mailbox, results, only_new)
+			running = len(self.mailboxes)
+			try:
+				while running:
+					item = results.get()
+					if item is None:
+						running -= 1
+						continue
+					yield item
+			finally:
+				#the consumer stopped early, let the workers finish their mailbox
+				self.stopped.set()
+				while running:
+					if results.get() is None:
+						running -= 1
+
+	def mark_fetched(self, fetched):
+		""" Remember [(email, uid), ...] as stored and write uidl_file. """
+		with self.lock:
+			for email, uid in fetched:
+				self.seen.setdefault(email, set()).add(uid)
+		self.save()
 
-		
\ No newline at end of file
+	def save(self):
+		if not self.uidl_file:
+			return
+		with open(self.uidl_file + '.tmp', 'w') as f:
+			json.dump(dict((k, sorted(v)) for k, v in self.seen.items()), f)
+		os.replace(self.uidl_file + '.tmp', self.uidl_file)
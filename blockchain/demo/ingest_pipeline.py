@@ -0,0 +1,241 @@
+'''-*- coding: utf-8 -*-'''
+
+import ssl
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import blockchain
+import email_track
+
+"""
+asyncio ingest pipeline: fetch --> MIME decode --> spam scoring --> block sealing
+
+Every stage reads from a bounded queue, so a slow stage holds the earlier
+ones back instead of piling up mail in memory. One process keeps hundreds of
+mailboxes flowing since a mailbox waiting on the network costs only a task.
+
+	pipeline = ingest_pipeline.IngestPipeline(chain, spam_chain, scorer)
+	asyncio.run(pipeline.run(mailboxes))
+	print(pipeline.report())
+"""
+
+
+class StageMetrics(object):
+	"""Items handled and latency of one pipeline stage."""
+	def __init__(self, name):
+		super(StageMetrics, self).__init__()
+		self.name = name
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def record(self, seconds):
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def mean(self):
+		return self.total / self.count if self.count else 0.0
+
+	def __repr__(self):
+		return 'Stage<{}: {} items, mean {:.2f} ms, max {:.2f} ms>'.format(
+			self.name, self.count, self.mean() * 1000, self.max * 1000
+		)
+
+
+class async_pop3(object):
+	"""Minimal asyncio POP3 client: USER/PASS, UIDL, RETR, QUIT."""
+	def __init__(self, host, port = 995, use_ssl = True, timeout = 30):
+		super(async_pop3, self).__init__()
+		self.host = host
+		self.port = port
+		self.use_ssl = use_ssl
+		self.timeout = timeout
+		self.reader = None
+		self.writer = None
+
+	async def _line(self):
+		line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+		if not line:
+			raise ConnectionError('POP3 connection closed')
+		return line.rstrip(b'\r\n')
+
+	async def _command(self, command):
+		self.writer.write(command.encode('utf-8') + b'\r\n')
+		await self.writer.drain()
+		response = await self._line()
+		if not response.startswith(b'+OK'):
+			raise ConnectionError('POP3 %s failed: %r' % (command.split()[0], response))
+		return response
+
+	async def _multiline(self, command):
+		await self._command(command)
+		lines = []
+		while True:
+			line = await self._line()
+			if line == b'.':
+				return lines
+			if line.startswith(b'..'):
+				line = line[1:]
+			lines.append(line)
+
+	async def login(self, user, password):
+		context = ssl.create_default_context() if self.use_ssl else None
+		self.reader, self.writer = await asyncio.wait_for(
+			asyncio.open_connection(self.host, self.port, ssl = context), self.timeout)
+		await self._line()	#greeting
+		await self._command('USER ' + user)
+		await self._command('PASS ' + password)
+
+	async def uidl(self):
+		""" [(message number, uid), ...] """
+		#RFC 1939 UIDs are printable ASCII, surrogateescape keeps a broken one unique
+		return [tuple(line.decode('ascii', 'surrogateescape').split(None, 1)) for line in await self._multiline('UIDL')]
+
+	async def retr(self, number):
+		return await self._multiline('RETR %s' % number)
+
+	async def quit(self):
+		try:
+			await self._command('QUIT')
+		finally:
+			self.writer.close()
+
+
+class IngestPipeline(object):
+	"""Bounded-queue asyncio pipeline from POP3 mailboxes into the chains.
+
+		scorer: callable(block_message) --> True for spam, None skips scoring.
+		Spam goes to spam_chain (when given), everything else to chain.
+		queue_size bounds every stage queue, decoders/scorers are the number
+		of concurrent tasks of those stages; their CPU work runs on a thread
+		pool so it does not stall the event loop.
+		A mail failing to decode, score or seal is recorded in errors under
+		(email, uid) and the pipeline goes on with the next one.
+	"""
+	def __init__(self, chain, spam_chain = None, scorer = None, queue_size = 256,
+			max_mailboxes = 100, decoders = 4, scorers = 2, port = 995, use_ssl = True):
+		super(IngestPipeline, self).__init__()
+		self.chain = chain
+		self.spam_chain = spam_chain
+		self.scorer = scorer
+		self.queue_size = queue_size
+		self.max_mailboxes = max_mailboxes
+		self.decoders = decoders
+		self.scorers = scorers
+		self.port = port
+		self.use_ssl = use_ssl
+		self.seen = set()	#(email, uid) already ingested
+		self.errors = {}	#email --> exception ending that mailbox, (email, uid) --> exception of one mail
+		self.metrics = dict((name, StageMetrics(name)) for name in ('fetch', 'decode', 'score', 'seal'))
+		self.decoder = email_track.fetch_email(None, None, None)
+		self.executor = None
+
+	async def _fetch(self, mailbox, limit, out):
+		email, password, pop3_server = mailbox
+		async with limit:
+			client = async_pop3(pop3_server, self.port, self.use_ssl)
+			try:
+				await client.login(email, password)
+				try:
+					for number, uid in await client.uidl():
+						if (email, uid) in self.seen:
+							continue
+						start = time.perf_counter()
+						lines = await client.retr(number)
+						self.metrics['fetch'].record(time.perf_counter() - start)
+						await out.put((email, uid, lines))
+				finally:
+					await client.quit()
+			except Exception as exc:
+				#one broken mailbox must not stop the hundreds of others
+				self.errors[email] = exc
+
+	def _decode_lines(self, lines):
+		return self.decoder.make_block_message(self.decoder.parse_lines(lines))
+
+	async def _decode(self, inq, out):
+		loop = asyncio.get_running_loop()
+		while True:
+			item = await inq.get()
+			if item is None:
+				return
+			email, uid, lines = item
+			start = time.perf_counter()
+			try:
+				block_message = await loop.run_in_executor(self.executor, self._decode_lines, lines)
+			except Exception as exc:
+				self.errors[(email, uid)] = exc
+				continue
+			self.metrics['decode'].record(time.perf_counter() - start)
+			await out.put((email, uid, block_message))
+
+	async def _score(self, inq, out):
+		loop = asyncio.get_running_loop()
+		while True:
+			item = await inq.get()
+			if item is None:
+				return
+			start = time.perf_counter()
+			spam = False
+			if self.scorer is not None:
+				try:
+					spam = bool(await loop.run_in_executor(self.executor, self.scorer, item[2]))
+				except Exception as exc:
+					#keep the mail, unscored it goes to the main chain
+					self.errors[item[:2]] = exc
+			self.metrics['score'].record(time.perf_counter() - start)
+			await out.put(item + (spam,))
+
+	async def _seal(self, inq):
+		""" The only stage touching the chains, so they need no locking. """
+		while True:
+			item = await inq.get()
+			if item is None:
+				break
+			email, uid, block_message, spam = item
+			start = time.perf_counter()
+			target = self.spam_chain if spam and self.spam_chain is not None else self.chain
+			try:
+				target.ingest(blockchain.Email_Content(block_message))
+			except Exception as exc:
+				self.errors[(email, uid)] = exc
+				continue
+			self.seen.add((email, uid))
+			self.metrics['seal'].record(time.perf_counter() - start)
+		self.chain.flush_ingest()
+		if self.spam_chain is not None:
+			self.spam_chain.flush_ingest()
+
+	async def run(self, mailboxes):
+		""" Ingest the new mail of every (email, password, pop3_server). """
+		raw = asyncio.Queue(self.queue_size)
+		decoded = asyncio.Queue(self.queue_size)
+		scored = asyncio.Queue(self.queue_size)
+		limit = asyncio.Semaphore(self.max_mailboxes)
+		self.executor = ThreadPoolExecutor(max_workers = self.decoders + self.scorers)
+
+		try:
+			decoders = [asyncio.ensure_future(self._decode(raw, decoded)) for i in range(self.decoders)]
+			scorers = [asyncio.ensure_future(self._score(decoded, scored)) for i in range(self.scorers)]
+			sealer = asyncio.ensure_future(self._seal(scored))
+
+			try:
+				await asyncio.gather(*[self._fetch(mailbox, limit, raw) for mailbox in mailboxes])
+			finally:
+				#shut the stages down in order, so whatever was fetched still gets sealed
+				for task in decoders:
+					await raw.put(None)
+				await asyncio.gather(*decoders)
+				for task in scorers:
+					await decoded.put(None)
+				await asyncio.gather(*scorers)
+				await scored.put(None)
+				await sealer
+		finally:
+			self.executor.shutdown()
+
+	def report(self):
+		return [self.metrics[name] for name in ('fetch', 'decode', 'score', 'seal')]
@@ -2,11 +2,13 @@
 
 import email_track
 import blockchain
+import blob_store
+import chain_store
 import spam_filter
 
+import os
+import copy
 import poplib
-import numpy as nu
-import pandas as pd
 
 def send_block():
 	user = input('Email user: ')
@@ -58,22 +60,79 @@ def print_chain(chain):
 		print('-------------------->')
 
 
-def judge_spam(chain, index, spam_chain, model, dictionary):
-	message_block = chain.chain[index]
-	for message in message_block.messages:
-		content = message.content
-		result_matrix = spam_filter.judge(content, model, dictionary)	#retunr confusion matrix
-		if result_matrix[0][0]:
+def judge_spam_range(chain, start, end, spam_chain, model, dictionary, threshold = 0.5):
+	""" Score every message of the blocks [start, end) in one batch and
+		store the spam in spam_chain as one block.
+		Returns [(message, spam probability), ...]
+	"""
+	messages = [message for i in range(start, end) for message in chain.chain[i].messages]
+	if not messages:
+		return []
+	probabilities = spam_filter.judge_batch([message.content for message in messages], model, dictionary)
+	#copies, linking them into the spam block must not touch the mail chain
+	spam = [copy.copy(message) for message, p in zip(messages, probabilities) if p >= threshold]
+	if spam:
+		block = blockchain.Block()
+		block.add_messages(spam)
+		spam_chain.add_block(block, validate = False)
+	return list(zip(messages, probabilities))
+
+def learn_labelled(online_model, state, chain, index, label):
+	""" partial_train() the online model on the messages of a block the user
+		labelled (1 --> spam, 0 --> ham).
+		state['labels'] maps block hash --> label, a block is learned only once.
+		Returns how many messages were learned, None when it was labelled before.
+	"""
+	block = chain.chain[index]
+	labels = state.setdefault('labels', {})
+	if block.hash in labels:
+		return None
+	messages = [message.content for message in block.messages]
+	if not messages:
+		return 0
+	spam_filter.partial_train(online_model, messages, [label] * len(messages))
+	labels[block.hash] = label
+	return len(messages)
+
+def judge_spam(chain, index, spam_chain, model, dictionary, online_model = None):
+	scored = judge_spam_range(chain, index, index + 1, spam_chain, model, dictionary)
+	if online_model is not None and scored:
+		online = spam_filter.judge_online([message.content for message, probability in scored], online_model)
+	else:
+		online = [None] * len(scored)
+	for (message, probability), learned in zip(scored, online):
+		if probability < 0.5:
 			print('The mail is Ham')
 		else:
 			print('The mail is Spam, store the spam in spam_chain')
-			block = blockchain.Block()
-			block.add_message(message)
-			spam_chain.add_block(block)
+		if learned is not None:
+			print('spam probability learned from your labels: %.2f' % learned)
+
+def fetch_into(fetcher, chain, only_new = True):
+	""" Ingest the new mail of an email_track.bulk_fetch_email into chain, returns how many.
+
+		UIDLs are only marked fetched once their messages are in a sealed block,
+		mail still pending when ingest fails is fetched again on the next run.
+	"""
+	count = 0
+	unsealed = []	#(email, uid) of the messages in chain.pending
+	for email, uid, block_message in fetcher.fetch(only_new):
+		unsealed.append((email, uid))
+		if chain.ingest(blockchain.Email_Content(block_message)) is not None:
+			fetcher.mark_fetched(unsealed)
+			count += len(unsealed)
+			unsealed = []
+	if chain.flush_ingest() is not None:
+		fetcher.mark_fetched(unsealed)
+		count += len(unsealed)
+	return count
 
 def manager():
-	chain = blockchain.Chain()
-	spam_chain = blockchain.Chain()
+	#chains are kept on disk and reopened on the next start
+	#mail contents are kept once in the blob store, shared by both chains
+	blobs = blob_store.BlobStore('mail_blobs')
+	chain = blockchain.Chain(chain_store.ChainStore('mail_chain', blobs = blobs))
+	spam_chain = blockchain.Chain(chain_store.ChainStore('spam_chain', blobs = blobs))
 	block = blockchain.Block()
 	flag = True
 
@@ -81,52 +140,75 @@ def manager():
 	#filter by naive bayes
 
 	'''
-	input feature_result.csv
+	load the model artifact, it is only trained on the first start
 	'''
-	df = pd.read_csv('feature_result.csv' ,header = None)
-	train_matrix = df.values
-	model, dictionary = spam_filter.train(train_matrix)
-
-	while flag:
-		print("\n####Email tracking demon by blockchain####")
-		option ="""
-		Action set:
-			(1) send email by smtp
-			(2) recieve&record in blockchain email by pop3
-			(3) show the email content(block)
-			(4) show the whole email chain
-			(5) judge the spam & store in spam chain
-			(6) show the spam chain
-			(7) exit
-				"""
-		print(option)
-		decide = input('-->Enter: ')
-		if decide == '1':
-			send_block()
-		elif decide == '2':
-			recieve_block(chain)
-		elif decide == '3':
-			index = int(input('input the index of the block: '))
-			print_info(chain, index)
-		elif decide == '4':
-			if len(chain.chain) > 0:
-				print_chain(chain)
-			else:
-				print('no block in the chain')
-		elif decide == '5':
-			if len(chain.chain) > 0:
+	model, dictionary = spam_filter.load_or_train('spam_model')
+	#the online model only learns from the blocks the user labels
+	online_path = os.path.join('spam_model', 'online.npz')
+	online_model, online_state = spam_filter.load_online_model(online_path)
+
+	try:
+		while flag:
+			print("\n####Email tracking demon by blockchain####")
+			option ="""
+			Action set:
+				(1) send email by smtp
+				(2) recieve&record in blockchain email by pop3
+				(3) show the email content(block)
+				(4) show the whole email chain
+				(5) judge the spam & store in spam chain
+				(6) show the spam chain
+				(7) label a block as ham or spam
+				(8) exit
+					"""
+			print(option)
+			decide = input('-->Enter: ')
+			if decide == '1':
+				send_block()
+			elif decide == '2':
+				recieve_block(chain)
+			elif decide == '3':
 				index = int(input('input the index of the block: '))
-				judge_spam(chain, index, spam_chain, model, dictionary)
-			else:
-				print('No block')
-		elif decide == '6':
-			if len(spam_chain.chain) > 0:
-				print_chain(spam_chain)
-			else:
-				print('No spam eamil in the chain')
-		elif decide == '7':
-			print('\nexit')
-			flag = False
+				print_info(chain, index)
+			elif decide == '4':
+				if len(chain.chain) > 0:
+					print_chain(chain)
+				else:
+					print('no block in the chain')
+			elif decide == '5':
+				if len(chain.chain) > 0:
+					index = int(input('input the index of the block: '))
+					judge_spam(chain, index, spam_chain, model, dictionary, online_model)
+				else:
+					print('No block')
+			elif decide == '6':
+				if len(spam_chain.chain) > 0:
+					print_chain(spam_chain)
+				else:
+					print('No spam eamil in the chain')
+			elif decide == '7':
+				if len(chain.chain) > 0:
+					index = int(input('input the index of the block: '))
+					label = input('(h)am or (s)pam: ').strip().lower()
+					if label not in ('h', 's'):
+						print('unknown label')
+						continue
+					learned = learn_labelled(online_model, online_state, chain, index, 1 if label == 's' else 0)
+					if learned is None:
+						print('the block is already labelled')
+					else:
+						if learned:
+							spam_filter.save_online_model(online_model, online_path, online_state)
+						print('learned %d mails' % learned)
+				else:
+					print('No block')
+			elif decide == '8':
+				print('\nexit')
+				flag = False
+	finally:
+		#also on Ctrl-C or an error, so refs.json and the indexes match the segments
+		chain.chain.close()
+		spam_chain.chain.close()
 
 if __name__ == '__main__':
 	manager()
\ No newline at end of file
@@ -2,80 +2,101 @@
 import os
 import numpy as np
 from collections import Counter
+from scipy.sparse import csr_matrix
 from sklearn.naive_bayes import MultinomialNB
+from sklearn.feature_extraction import FeatureHasher
 from sklearn.svm import LinearSVC
 from sklearn.metrics import confusion_matrix
 
 import copy
+import json
+from multiprocessing import Pool
+import hashlib
 import pandas as pd
 
 #prepare extract object
 #training
-def make_Dictionary(train_dir):
-    emails = [os.path.join(train_dir,f) for f in os.listdir(train_dir)]    
-    all_words = []       
-    for mail in emails:    
+#count the body words of a shard of mails, only words the dictionary can keep
+def _count_words(mails):
+    counter = Counter()
+    for mail in mails:
         with open(mail) as m:
             for i,line in enumerate(m):
                 if i == 2:
-                    words = line.split()
-                    all_words += words
-    
-    dictionary = Counter(all_words)
-    
-    list_to_remove = list(dictionary.keys())
-    for item in list_to_remove:
+                    counter.update(line.split())
+    for item in list(counter.keys()):
         if item.isalpha() == False: 
-            del dictionary[item]
+            del counter[item]
         elif len(item) == 1:
-            del dictionary[item]
-    dictionary = dictionary.most_common(3000)
+            del counter[item]
+    return counter
+
+#most common 3000 words, ties broken by the word so every run builds the same dictionary
+def make_Dictionary(train_dir, processes = None, shard_size = 200):
+    emails = [os.path.join(train_dir,f) for f in os.listdir(train_dir)]    
+    shards = [emails[i:i + shard_size] for i in range(0, len(emails), shard_size)]
+    dictionary = Counter()
+    if processes == 1 or len(emails) < 2000:  #a pool does not pay off for small corpora
+        for shard in shards:
+            dictionary.update(_count_words(shard))
+    else:
+        #shards are counted in parallel and merged as they finish
+        with Pool(processes) as pool:
+            for counter in pool.imap_unordered(_count_words, shards):
+                dictionary.update(counter)
+    dictionary = sorted(dictionary.items(), key = lambda d: (-d[1], d[0]))[:FEATURES]
     return dictionary
 
-#email features    
-def extract_features(mail_dir, dictionary): 
-    files = [os.path.join(mail_dir,fi) for fi in os.listdir(mail_dir)]
-    features_matrix = np.zeros((len(files),3000))
-    docID = 0;
-    for fil in files:
-      with open(fil) as fi:
-        for i,line in enumerate(fi):
-          if i == 2:
-            words = line.split()
-            for word in words:
-              wordID = 0
-              for i,d in enumerate(dictionary):
-                if d[0] == word:
-                  wordID = i
-                  features_matrix[docID,wordID] = words.count(word)
-        docID = docID + 1     
-    return features_matrix
+FEATURES = 3000  #columns of the feature matrix, one per dictionary word
 
+#word --> column of the feature matrix
+def make_vocabulary(dictionary):
+    return dict((d[0], i) for i, d in enumerate(dictionary))
 
-def extract_test_email_features(mail_dir, dictionary):
-    features_matrix = np.zeros((1, 3000))
-    docID = 0;
-    '''
-    words = mail_dir.split()
-    for word in words:
-        wordID = 0
-        for i, d in enumerate(dictionary):
-            if d[0] == word:
-                wordID = i
-                features_matrix[docID, wordID] = words.count(word)
-    '''
+#words of a mail: a string, or a decoded email (nested lists, attachments skipped)
+def mail_words(mail):
+    if isinstance(mail, str):
+        return mail.split()
     words = []
-    for string in mail_dir:
-        words += string.split()
+    for part in mail:
+        if isinstance(part, (str, list, tuple)):
+            words += mail_words(part)
+    return words
+
+#the body is the third line of a ling-spam mail
+def read_mail_body(path):
+    with open(path) as m:
+        for i, line in enumerate(m):
+            if i == 2:
+                return line.split()
+    return []
 
-    for word in words:
-        wordID = 0
-        for i, d in enumerate(dictionary):
-            if d[0] == word:
-                wordID = i
-                features_matrix[docID, wordID] = words.count(word)
+#count the dictionary words of every mail in one pass, sparse CSR rows
+def vectorize(word_lists, vocabulary):
+    indptr = [0]
+    indices = []
+    data = []
+    for words in word_lists:
+        counts = Counter(words)
+        for word, count in counts.items():
+            column = vocabulary.get(word)
+            if column is not None:
+                indices.append(column)
+                data.append(count)
+        indptr.append(len(indices))
+    return csr_matrix((data, indices, indptr), shape = (len(indptr) - 1, FEATURES), dtype = np.float64)
+
+def extract_features_sparse(mail_dir, dictionary):
+    files = [os.path.join(mail_dir,fi) for fi in os.listdir(mail_dir)]
+    return vectorize((read_mail_body(fil) for fil in files), make_vocabulary(dictionary))
+
+#email features    
+def extract_features(mail_dir, dictionary): 
+    return extract_features_sparse(mail_dir, dictionary).toarray()
 
-    return features_matrix
+
+def extract_test_email_features(mail_dir, dictionary):
+    return vectorize([mail_words(mail_dir)], make_vocabulary(dictionary)).toarray()
 
         
 #1-->spam
@@ -110,3 +131,143 @@ def judge(test_dir, model, dictionary):
     result = model.predict(test_matrix)
     #result_matrix = confusion_matrix(test_label, result)
     return result
+
+#spam probability of every mail: one sparse matrix, one predict call
+def judge_batch(mails, model, dictionary, vocabulary = None):
+    if vocabulary is None:
+        vocabulary = make_vocabulary(dictionary)
+    test_matrix = vectorize((mail_words(mail) for mail in mails), vocabulary)
+    return model.predict_proba(test_matrix)[:, list(model.classes_).index(1)]
+
+
+MODEL_FORMAT = 1  #bump when the artifact layout changes
+MODEL_ARRAYS = ['classes', 'class_count', 'feature_count', 'class_log_prior', 'feature_log_prob']
+
+#ling-spam names spam mails spmsg*.txt
+def mail_labels(files):
+    return np.array([1 if os.path.basename(f).startswith('spmsg') else 0 for f in files], dtype = np.float64)
+
+def _file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+#model artifact: <model_dir>/<hash>/{vocabulary.json, *.npy, meta.json}
+#<model_dir>/CURRENT names the artifact in use, the hash covers every file
+def save_model(model, dictionary, model_dir):
+    if not os.path.isdir(model_dir):
+        os.makedirs(model_dir)
+    temp_dir = os.path.join(model_dir, 'building')
+    if not os.path.isdir(temp_dir):
+        os.makedirs(temp_dir)
+    files = {}
+    with open(os.path.join(temp_dir, 'vocabulary.json'), 'w') as f:
+        json.dump([[word, count] for word, count in dictionary], f)
+    files['vocabulary.json'] = _file_hash(os.path.join(temp_dir, 'vocabulary.json'))
+    for name in MODEL_ARRAYS:
+        np.save(os.path.join(temp_dir, name + '.npy'), np.ascontiguousarray(getattr(model, name + '_')))
+        files[name + '.npy'] = _file_hash(os.path.join(temp_dir, name + '.npy'))
+    version = hashlib.sha256(json.dumps(sorted(files.items())).encode('utf-8')).hexdigest()[:16]
+    with open(os.path.join(temp_dir, 'meta.json'), 'w') as f:
+        json.dump({'format': MODEL_FORMAT, 'version': version, 'alpha': model.alpha, 'files': files}, f)
+
+    artifact_dir = os.path.join(model_dir, version)
+    if os.path.isdir(artifact_dir):  #same model was built before
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+    else:
+        os.rename(temp_dir, artifact_dir)
+    with open(os.path.join(model_dir, 'CURRENT.tmp'), 'w') as f:
+        f.write(version)
+    os.replace(os.path.join(model_dir, 'CURRENT.tmp'), os.path.join(model_dir, 'CURRENT'))
+    return version
+
+#load an artifact, the arrays are memory-mapped; None when it is missing or stale
+def load_model(model_dir, version = None, verify = True):
+    if version is None:
+        current = os.path.join(model_dir, 'CURRENT')
+        if not os.path.exists(current):
+            return None
+        with open(current) as f:
+            version = f.read().strip()
+    artifact_dir = os.path.join(model_dir, version)
+    meta_path = os.path.join(artifact_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['format'] != MODEL_FORMAT:
+        return None
+    if verify:
+        for name, digest in meta['files'].items():
+            if _file_hash(os.path.join(artifact_dir, name)) != digest:
+                raise ValueError('model artifact %s is corrupt: %s' % (version, name))
+
+    with open(os.path.join(artifact_dir, 'vocabulary.json')) as f:
+        dictionary = [tuple(d) for d in json.load(f)]
+    model = MultinomialNB(alpha = meta['alpha'])
+    for name in MODEL_ARRAYS:
+        setattr(model, name + '_', np.load(os.path.join(artifact_dir, name + '.npy'), mmap_mode = 'r'))
+    model.n_features_in_ = model.feature_count_.shape[1]
+    return model, dictionary
+
+#reuse the current model artifact, train and save one only when there is none
+def load_or_train(model_dir = 'spam_model', train_dir = os.path.join('ling-spam', 'train-mails')):
+    loaded = load_model(model_dir)
+    if loaded is not None:
+        return loaded
+    dictionary = make_Dictionary(train_dir)
+    files = [os.path.join(train_dir,fi) for fi in os.listdir(train_dir)]
+    train_matrix = vectorize((read_mail_body(fil) for fil in files), make_vocabulary(dictionary))
+    model = MultinomialNB()
+    model.fit(train_matrix, mail_labels(files))
+    save_model(model, dictionary, model_dir)
+    return model, dictionary
+
+
+#online model: hashed features, so new words never change the feature space
+HASHED_FEATURES = 2 ** 18
+ONLINE_ARRAYS = ['classes', 'class_count', 'feature_count']
+
+def hash_features(mails, n_features = HASHED_FEATURES):
+    hasher = FeatureHasher(n_features = n_features, input_type = 'string', alternate_sign = False)
+    return hasher.transform(mail_words(mail) for mail in mails)
+
+def new_online_model():
+    return MultinomialNB()
+
+#update the model with newly labelled mails (1-->spam, 0-->ham), cost only depends on the new mails
+def partial_train(model, mails, labels, n_features = HASHED_FEATURES):
+    model.partial_fit(hash_features(mails, n_features), np.asarray(labels, dtype = np.float64), classes = [0, 1])
+    return model
+
+#no labelled mail yet --> every mail is undecided
+def judge_online(mails, model):
+    if not hasattr(model, 'classes_'):
+        return np.full(len(mails), 0.5)
+    test_matrix = hash_features(mails, model.n_features_in_)
+    return model.predict_proba(test_matrix)[:, list(model.classes_).index(1)]
+
+#checkpoint: the counts are enough to rebuild and keep updating the model
+#state is json data saved with it, e.g. how far each chain was learned
+def save_online_model(model, path, state = None):
+    arrays = dict((name, getattr(model, name + '_')) for name in ONLINE_ARRAYS)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, alpha = model.alpha, state = json.dumps(state or {}), **arrays)
+    os.replace(path + '.tmp', path)
+
+def load_online_model(path):
+    if not os.path.exists(path):
+        return new_online_model(), {}
+    with np.load(path) as data:
+        model = MultinomialNB(alpha = float(data['alpha']))
+        for name in ONLINE_ARRAYS:
+            setattr(model, name + '_', np.array(data[name]))
+        state = json.loads(str(data['state']))
+    model.n_features_in_ = model.feature_count_.shape[1]
+    model._update_class_log_prior()
+    model._update_feature_log_prob(model.alpha)
+    return model, state
@@ -39,11 +39,9 @@ test_num = 0
 '''
 mining text data
 filter by naive bayes
-input feature_result.csv
+load (or build once) the model artifact
 '''
-df = pd.read_csv('feature_result.csv', header=None)
-train_matrix = df.values
-model, dictionary = spam_filter.train(train_matrix)
+model, dictionary = spam_filter.load_or_train('spam_model')
 spam_list = add_block(chain)	#return the list of spam
 
 # temp = chain.chain[0].messages[0].content_hash
@@ -63,11 +61,9 @@ times_chain = []
 for mail in mail_hash:	
 	subtime = 0
 	for i in range(1,10):
-		start = time.clock()
-		for block in chain.chain:
-			if block.messages[0].content_hash == mail:
-				break;
-		end = time.clock()
+		start = time.perf_counter()
+		chain.has_content(mail)	#content_hash index instead of scanning chain.chain
+		end = time.perf_counter()
 		subtime += (end-start)
 
 	sub_mean = subtime/10.0
@@ -90,9 +86,9 @@ print(mean)
 # 	    #print(context)
 #     subtime = 0
 #     for i in range(1, 10):
-#     	start = time.clock()
+#     	start = time.perf_counter()
 #     	result = spam_filter.judge(context, model, dictionary)
-#     	end = time.clock()
+#     	end = time.perf_counter()
 #     	subtime += (end-start)
 #     	sub_mean = subtime/10.0
 #     	times_learning.append(sub_mean)
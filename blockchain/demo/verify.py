@@ -0,0 +1,115 @@
+'''-*- coding: utf-8 -*-'''
+
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import blockchain
+import chain_store
+
+"""
+Parallel full-chain audit.
+
+The chain is cut into block ranges, every range is checked in a worker
+process (message payload/link hashes, block hashes, links inside the range),
+then the pre_hash links at the range boundaries are stitched in the parent.
+"""
+
+
+def _encoded_blocks(chain, start, end):
+	""" Records of blocks [start, end), stores hand out their raw bytes
+		unless the content lives in a blob store the workers can not read.
+	"""
+	if isinstance(chain.chain, chain_store.ChainStore) and chain.chain.blobs is None:
+		return [chain.chain.raw_record(i) for i in range(start, end)]
+	return [json.dumps(chain_store.block_to_record(chain.chain[i])).encode('utf-8')
+		for i in range(start, end)]
+
+def _verify_range(start, records):
+	""" Worker: validate one range of encoded blocks.
+
+		Returns (start, first pre_hash, last hash, messages, bytes, error)
+		where error is None or (block number, reason).
+	"""
+	pre_hash = None
+	messages = 0
+	size = 0
+	first_pre_hash = None
+	for i, data in enumerate(records):
+		size += len(data)
+		block = chain_store.block_from_record(json.loads(data.decode('utf-8')))
+		if i == 0:
+			first_pre_hash = block.pre_hash
+		try:
+			block.validate()
+			if i > 0 and block.pre_hash != pre_hash:
+				raise blockchain.InvalidBlock("Invalid block: block has invalid block link: {}".format(str(block)))
+		except blockchain.InvalidBlock as exc:
+			return start, first_pre_hash, pre_hash, messages, size, (start + i, str(exc))
+		pre_hash = block.hash
+		messages += len(block.messages)
+	return start, first_pre_hash, pre_hash, messages, size, None
+
+def verify_chain(chain, workers = None, range_size = 1000):
+	""" Validate the whole chain across a process pool.
+
+		Raises InvalidBlockchain for the first invalid block, otherwise
+		returns the throughput report:
+			{'blocks', 'messages', 'bytes', 'seconds', 'blocks_per_s', 'mb_per_s', 'workers'}
+	"""
+	workers = workers or os.cpu_count() or 1
+	total = len(chain.chain)
+	started = time.perf_counter()
+	ranges = [(start, min(start + range_size, total)) for start in range(0, total, range_size)]
+	results = {}
+	with ProcessPoolExecutor(max_workers = workers) as pool:
+		pending = []
+		for start, end in ranges:
+			pending.append(pool.submit(_verify_range, start, _encoded_blocks(chain, start, end)))
+			#keep a bounded number of ranges in memory
+			if len(pending) >= workers * 2:
+				result = pending.pop(0).result()
+				results[result[0]] = result
+		for future in pending:
+			result = future.result()
+			results[result[0]] = result
+
+	messages = 0
+	size = 0
+	last_hash = None
+	for start, end in ranges:
+		start, first_pre_hash, range_hash, range_messages, range_size, error = results[start]
+		if error is not None:
+			raise blockchain.InvalidBlockchain("Invalid blockchain at block number {} caused by: {}".format(*error))
+		if start > 0 and first_pre_hash != last_hash:
+			raise blockchain.InvalidBlockchain(
+				"Invalid blockchain at block number {} caused by: invalid block link".format(start)
+			)
+		last_hash = range_hash
+		messages += range_messages
+		size += range_size
+
+	seconds = time.perf_counter() - started
+	return {
+		'blocks': total,
+		'messages': messages,
+		'bytes': size,
+		'seconds': seconds,
+		'blocks_per_s': total / seconds if seconds else 0.0,
+		'mb_per_s': size / seconds / (1024 * 1024) if seconds else 0.0,
+		'workers': workers,
+	}
+
+if __name__ == '__main__':
+	from argparse import ArgumentParser
+
+	parser = ArgumentParser()
+	parser.add_argument('directory', help = 'chain_store directory to audit')
+	parser.add_argument('-w', '--workers', default = None, type = int)
+	parser.add_argument('-r', '--range-size', default = 1000, type = int)
+	args = parser.parse_args()
+
+	report = verify_chain(blockchain.Chain(chain_store.ChainStore(args.directory)), args.workers, args.range_size)
+	print('%(blocks)d blocks, %(messages)d messages in %(seconds).2fs: '
+		'%(blocks_per_s).0f blocks/s, %(mb_per_s).2f MB/s on %(workers)d workers' % report)